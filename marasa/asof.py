@@ -0,0 +1,84 @@
+
+from bisect import bisect_right
+from collections.abc import Mapping
+from types import MappingProxyType
+from typing import Any, Dict, Iterator, List, Tuple
+
+from .lines import bounded_lines
+
+
+class AsOf(Mapping):
+    """
+    A lazy, read-only mapping of namespace to state for every namespace of a StateKeeper as of :seq:.
+
+    The storage directory is scanned once, when the view is made, instead of once per namespace;
+    each namespace is replayed from its nearest segment base on first access, and kept.
+    Segments at or before :seq: are never rewritten, so the view stays consistent while writes go on.
+    Commits not yet copied into the segments, and coalesced puts not yet written, are taken from memory,
+    as of when the view is made.
+    """
+
+    def __init__(self, db, seq: int):
+        self.db = db
+        self.seq = seq
+        self.seg = seq // db.segment_size
+        self._segs: Dict[str, List[int]] = {}
+        for f in db.dir.glob('*.*'):
+            if f.is_file():
+                ns, seg = f.name.split('.', 1)
+                if int(seg) <= self.seg:
+                    self._segs.setdefault(ns, []).append(int(seg))
+        for segs in self._segs.values():
+            segs.sort()
+        # namespace: [(seqno, changes)] not in the segments yet, at or before seq
+        self._pending: Dict[str, List[Tuple[int, Dict[str, Any]]]] = {}
+        for seqno, unwritten in db._unwritten():
+            if seqno <= seq:
+                for ns, changes in unwritten.items():
+                    self._pending.setdefault(ns, []).append((seqno, changes))
+        self._states: Dict[str, Any] = {}
+        self._names: List[str] = []
+
+    def _exists(self, namespace: str) -> bool:
+        """whether the namespace had any changes at or before seq"""
+        if namespace in self._pending:
+            return True
+        segs = self._segs.get(namespace)
+        if not segs:
+            return False
+        if segs[0] < self.seg:
+            return True
+        # its first segment is seq's; see if it starts in time
+        segfile = self.db._segfile_for_seg(namespace, segs[0])
+        first = next(self.db._segfile_reader(bounded_lines(segfile, pool=self.db.handles)), None)
+        return first is not None and first[0] <= self.seq
+
+    def __getitem__(self, namespace: str):
+        if namespace in self._states:
+            return self._states[namespace]
+        if not self._exists(namespace):
+            raise KeyError(namespace)
+        state: Dict[str, Any] = {}
+        segs = self._segs.get(namespace)
+        if segs:
+            segfile = self.db._segfile_for_seg(namespace, segs[bisect_right(segs, self.seg) - 1])
+            state = self.db._seg_base(namespace, segfile)
+            for seq, data in self.db._segfile_reader(bounded_lines(segfile, pool=self.db.handles)):
+                if seq > self.seq:
+                    break
+                state.update(data)
+        for _, data in self._pending.get(namespace, ()):
+            state.update(data)
+        self._states[namespace] = MappingProxyType(state)
+        return self._states[namespace]
+
+    def __iter__(self) -> Iterator[str]:
+        if not self._names:
+            self._names = sorted(ns for ns in self._segs.keys() | self._pending.keys() if self._exists(ns))
+        return iter(self._names)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __contains__(self, namespace) -> bool:
+        return namespace in self._states or self._exists(namespace)
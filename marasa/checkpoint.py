@@ -0,0 +1,66 @@
+
+import queue
+import logging
+import threading
+import weakref
+from typing import Callable, Optional
+
+_STOP = object()
+
+
+class Checkpointer:
+    """
+    Writes segment base-state checkpoints in a background thread, so starting a new segment
+    doesn't have to serialize a whole namespace on the put path.
+
+    :build: is a bound method, called as build(namespace, seg) for each submitted segment, in the order
+    submitted.  Only a weak reference to it is kept, so the thread doesn't keep its owner alive; the
+    thread stops when the owner is collected, or on .close().
+    A failed build is only logged: readers rebuild a missing checkpoint from earlier segments.
+    """
+
+    def __init__(self, build: Callable[[str, int], None]):
+        self._build = weakref.WeakMethod(build)  # type: ignore
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        # don't leave the thread waiting forever once the owner is gone
+        weakref.finalize(build.__self__, self._queue.put, _STOP)  # type: ignore
+
+    def submit(self, namespace: str, seg: int):
+        """queue up the checkpoint for the start of segment :seg: of :namespace:"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, args=(self._queue, self._build),
+                                                name='marasa-checkpoint', daemon=True)
+                self._thread.start()
+        self._queue.put((namespace, seg))
+
+    @staticmethod
+    def _run(jobs: queue.Queue, ref: weakref.WeakMethod):
+        while True:
+            item = jobs.get()
+            try:
+                if item is _STOP:
+                    return
+                build = ref()
+                if build is None:
+                    return
+                build(*item)
+            except Exception as e:  # pylint: disable=broad-except
+                logging.warning("checkpoint of %r failed: %r", item, e)
+            finally:
+                build = None
+                jobs.task_done()
+
+    def flush(self):
+        """wait for every submitted checkpoint to be written"""
+        self._queue.join()
+
+    def close(self):
+        """write any submitted checkpoints, then stop the thread"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(_STOP)
+            thread.join()
@@ -0,0 +1,94 @@
+
+import struct
+from abc import ABC, abstractmethod
+from base64 import b85encode, b85decode
+from collections.abc import Mapping
+from typing import Any, Dict, Optional, Sequence, Union
+
+import orjson as json
+
+
+class Codec(ABC):
+    """
+    Turns events into the data stored in a segment, and back.
+
+    :name: identifies the codec; it's recorded in the header of each segment written with it,
+    so segments are always decoded with the codec they were written with.
+
+    .encode() may return bytes (which are written as-is) or a str; either way it must be a single
+    line of utf8 text.  .decode() is passed the stored data, with a trailing newline if it was read
+    back from a segment: as bytes from .read_columns(), which never decodes the payloads, and
+    as a str otherwise.
+    """
+
+    name = ''
+
+    @abstractmethod
+    def encode(self, event) -> Union[bytes, str]:
+        pass
+
+    @abstractmethod
+    def decode(self, data: Union[bytes, str]):
+        pass
+
+
+class JsonCodec(Codec):
+    """json via orjson, which never puts a newline in its output"""
+
+    name = 'json'
+
+    def encode(self, event) -> bytes:
+        return json.dumps(event)
+
+    def decode(self, data: Union[bytes, str]):
+        return json.loads(data)
+
+
+class StructCodec(Codec):
+    """
+    A fixed schema: the :fields: of each event (keys of a mapping, or else attributes), packed with
+    struct format :fmt:, then base85-encoded so the record stays a line of text.
+    Events decode to dicts of field: value.
+
+        StructCodec('metric', '<qd', ('ts', 'value'))
+    """
+
+    def __init__(self, name: str, fmt: str, fields: Sequence[str]):
+        if not name or any(c.isspace() for c in name):
+            raise ValueError(f"Invalid codec name {name!r}")
+        self.name = name
+        self.fields = tuple(fields)
+        self._struct = struct.Struct(fmt)
+        if len(self.fields) != len(self._struct.unpack(bytes(self._struct.size))):
+            raise ValueError(f"{fmt!r} doesn't pack {len(self.fields)} fields")
+
+    def encode(self, event) -> bytes:
+        if isinstance(event, Mapping):
+            values = [ event[f] for f in self.fields ]
+        else:
+            values = [ getattr(event, f) for f in self.fields ]
+        return b85encode(self._struct.pack(*values))
+
+    def decode(self, data: Union[bytes, str]) -> Dict[str, Any]:
+        if isinstance(data, str):
+            data = data.encode('ascii')
+        return dict(zip(self.fields, self._struct.unpack(b85decode(data.rstrip(b'\n')))))
+
+
+JSON = JsonCodec()
+
+# codecs that can be found by name, for segments written with a codec a log isn't configured with
+CODECS: Dict[str, Codec] = { JSON.name: JSON }
+
+
+def register_codec(codec: Codec):
+    """make :codec: available by name to every log"""
+    CODECS[codec.name] = codec
+
+
+def find_codec(name: str, configured: Optional[Dict[str, Codec]] = None) -> Codec:
+    """the codec called :name:, preferring those in :configured: (name: codec) over registered ones"""
+    codec = (configured or {}).get(name) or CODECS.get(name)
+    if codec is None:
+        raise ValueError(f"Unknown codec {name!r}")
+    return codec
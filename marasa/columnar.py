@@ -0,0 +1,90 @@
+
+from array import array
+from typing import Dict, List, Optional, Callable, Tuple, Any
+
+
+# typecode -> extractor, used to fill a typed column from each deserialized event
+FieldSpec = Dict[str, Tuple[str, Callable[[Any], Any]]]
+
+
+class ColumnBatch:
+    """
+    A range of log events laid out as columns rather than one tuple per event.
+
+        .seqnos     array('q') of sequence numbers
+        .tag_codes  array('i') of indexes into .tags (dictionary-encoded tags)
+        .tags       list of the distinct tags, in first-seen order
+        .offsets    array('q') of len(self)+1 offsets into .buffer; event i's payload
+                    is buffer[offsets[i]:offsets[i+1]]
+        .buffer     one contiguous bytes object holding every payload (utf8)
+        .columns    dict of name: array for any extracted fields
+
+    Arrays are from the stdlib `array` module; .to_numpy() will wrap them without copying
+    if numpy is available.
+    """
+
+    def __init__(self):
+        self.seqnos = array('q')
+        self.tag_codes = array('i')
+        self.tags: List[str] = []
+        self.offsets = array('q', [0])
+        self.buffer = b''
+        self.columns: Dict[str, array] = dict()
+        self._tagcodes: Dict[str, int] = dict()
+        self._buf = bytearray()
+
+    def __len__(self):
+        return len(self.seqnos)
+
+    def append(self, seqno: int, tag: str, payload: bytes):
+        code = self._tagcodes.get(tag)
+        if code is None:
+            code = self._tagcodes[tag] = len(self.tags)
+            self.tags.append(tag)
+        self.seqnos.append(seqno)
+        self.tag_codes.append(code)
+        self._buf += payload
+        self.offsets.append(len(self._buf))
+
+    def finish(self) -> 'ColumnBatch':
+        """freeze the accumulated payloads into .buffer"""
+        self.buffer = bytes(self._buf)
+        self._buf = bytearray()
+        return self
+
+    def payload(self, i: int) -> bytes:
+        return self.buffer[self.offsets[i]:self.offsets[i+1]]
+
+    def tag(self, i: int) -> str:
+        return self.tags[self.tag_codes[i]]
+
+    def to_numpy(self) -> Dict[str, Any]:
+        """
+        Return a dict of the columns as numpy arrays (zero-copy where possible).
+        Raises ImportError if numpy isn't installed.
+        """
+        import numpy as np  # type: ignore  # pylint: disable=import-outside-toplevel
+        result = { 'seqnos': np.frombuffer(self.seqnos, dtype=np.int64)
+                 , 'tag_codes': np.frombuffer(self.tag_codes, dtype=np.int32)
+                 , 'tags': np.array(self.tags, dtype=object)
+                 , 'offsets': np.frombuffer(self.offsets, dtype=np.int64)
+                 , 'buffer': np.frombuffer(self.buffer, dtype=np.uint8)
+                 }
+        for name, col in self.columns.items():
+            result[name] = np.frombuffer(col, dtype=col.typecode)
+        return result
+
+
+def fill_columns(batch: ColumnBatch, events, fields: Optional[FieldSpec]):
+    """
+    Given an iterable of deserialized events in the same order as batch's rows,
+    fill batch.columns according to :fields:, a dict of column name: (array typecode, extractor)
+    """
+    if not fields:
+        return batch
+    cols = [ (batch.columns.setdefault(name, array(typecode)).append, extract)
+             for name, (typecode, extract) in fields.items() ]
+    for event in events:
+        for append, extract in cols:
+            append(extract(event))
+    return batch
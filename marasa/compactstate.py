@@ -0,0 +1,238 @@
+
+import os
+import mmap
+import struct
+import logging
+from array import array
+from pathlib import Path
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+
+import orjson as json
+
+from .constants import NOTFOUND
+
+# index file layout:
+#   header: seqno of the checkpoint, number of entries
+#   entries: (key offset, key length, value offset, value length), sorted by key
+#   then all the keys, utf8-encoded, back to back
+# values are stored back to back, json-encoded, in a separate file
+_HEADER = struct.Struct('<QQ')
+_ENTRY = struct.Struct('<QIQI')
+
+
+class CompactIndex:
+    """
+    A read-only, mmapped, sorted key index over a values file.
+    Lookups are a binary search over fixed-size entries, so only the pages touched are resident.
+    """
+
+    def __init__(self, idxfile: Path, datfile: Path):
+        self.idxfile = idxfile
+        self.datfile = datfile
+        self.seq = 0
+        self._count = 0
+        self._idx: Optional[mmap.mmap] = None
+        self._dat: Optional[mmap.mmap] = None
+        if idxfile.exists() and datfile.exists():
+            self._open()
+
+    def _open(self):
+        with self.idxfile.open('rb') as f:
+            self._idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.seq, self._count = _HEADER.unpack_from(self._idx, 0)
+        if self.datfile.stat().st_size:
+            with self.datfile.open('rb') as f:
+                self._dat = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        for m in (self._idx, self._dat):
+            if m is not None:
+                m.close()
+        self._idx = self._dat = None
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _entry(self, i: int) -> Tuple[bytes, int, int]:
+        assert self._idx is not None
+        koff, klen, voff, vlen = _ENTRY.unpack_from(self._idx, _HEADER.size + i * _ENTRY.size)
+        return self._idx[koff:koff+klen], voff, vlen
+
+    def _value(self, voff: int, vlen: int) -> Any:
+        assert self._dat is not None
+        return json.loads(self._dat[voff:voff+vlen])
+
+    def get(self, key: str, default=NOTFOUND) -> Any:
+        target = key.encode('utf8')
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            k, voff, vlen = self._entry(mid)
+            if k < target:
+                lo = mid + 1
+            elif k > target:
+                hi = mid
+            else:
+                return self._value(voff, vlen)
+        return default
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        """all (key, value) pairs, in sorted key order"""
+        for i in range(self._count):
+            k, voff, vlen = self._entry(i)
+            yield k.decode('utf8'), self._value(voff, vlen)
+
+    @classmethod
+    def write(cls, idxfile: Path, datfile: Path, seq: int, items: Iterable[Tuple[str, Any]]) -> 'CompactIndex':
+        """
+        Write a new index from :items: (which must be sorted by key) and return it opened.
+        The files are written alongside and renamed into place, so a crash leaves the old index intact.
+        """
+        entries = array('Q')
+        keys = bytearray()
+        tmpdat = datfile.with_name(datfile.name + '.tmp')
+        with tmpdat.open('wb') as dat:
+            voff = 0
+            for key, value in items:
+                k = key.encode('utf8')
+                v = json.dumps(value)
+                dat.write(v)
+                entries.extend((len(keys), len(k), voff, len(v)))
+                keys += k
+                voff += len(v)
+        count = len(entries) // 4
+        keybase = _HEADER.size + count * _ENTRY.size
+        tmpidx = idxfile.with_name(idxfile.name + '.tmp')
+        with tmpidx.open('wb') as idx:
+            idx.write(_HEADER.pack(seq, count))
+            for i in range(0, len(entries), 4):
+                koff, klen, voff, vlen = entries[i:i+4]
+                idx.write(_ENTRY.pack(keybase + koff, klen, voff, vlen))
+            idx.write(keys)
+        os.replace(tmpdat, datfile)
+        os.replace(tmpidx, idxfile)
+        return cls(idxfile, datfile)
+
+
+class CompactStateDict(Mapping):
+    """
+    A drop-in for StateDict that keeps at most :budget: keys in memory.
+    Writes since the last checkpoint and recently-read keys are held in memory;
+    everything else is looked up in a mmapped CompactIndex.  When the unwritten
+    changes exceed the budget, they're merged into a new checkpoint.
+    Changes that aren't in the segments yet are staged: they're visible, but never checkpointed,
+    so a checkpoint never gets ahead of the segments it's replayed against.
+    :base: if given, is the index to start from when the namespace has no checkpoint of its own yet.
+    """
+
+    def __init__(self, directory: Path, namespace: str, budget: int, base: Optional[CompactIndex] = None):
+        self.budget = budget
+        self.dir = directory
+        if not self.dir.exists():
+            self.dir.mkdir()
+        self._idxfile = self.dir / f"{namespace}.idx"
+        self._datfile = self.dir / f"{namespace}.dat"
+        self.index = CompactIndex(self._idxfile, self._datfile)
+        if base is not None and not self.index.seq and not len(self.index):
+            self.index = base
+        # seq is the latest change seen, written_seq the latest one in the segments
+        self.seq = self.written_seq = self.index.seq
+        self._dirty: Dict[str, Any] = dict()
+        self._staged: Dict[str, Tuple[int, Any]] = dict()
+        self._hot: OrderedDict = OrderedDict()
+
+    def __getitem__(self, key):
+        if key in self._staged:
+            return self._staged[key][1]
+        if key in self._dirty:
+            return self._dirty[key]
+        if key in self._hot:
+            self._hot.move_to_end(key)
+            return self._hot[key]
+        value = self.index.get(key)
+        if value is NOTFOUND:
+            raise KeyError(key)
+        self._hot[key] = value
+        while self._hot and len(self._hot) + len(self._dirty) > self.budget:
+            self._hot.popitem(last=False)
+        return value
+
+    def __contains__(self, key):
+        return key in self._staged or key in self._dirty or key in self._hot or self.index.get(key) is not NOTFOUND
+
+    def __iter__(self):
+        for key, _ in self.items():
+            yield key
+
+    def __len__(self):
+        changed = self._dirty.keys() | self._staged.keys()
+        return len(self.index) + sum(1 for k in changed if self.index.get(k) is NOTFOUND)
+
+    def _merged(self, changes: Dict[str, Any]) -> Iterator[Tuple[str, Any]]:
+        """the index's (key, value) pairs overlaid with :changes:, in sorted key order"""
+        overlay = iter(sorted(changes.items()))
+        pending = next(overlay, None)
+        for key, value in self.index.items():
+            while pending is not None and pending[0] < key:
+                yield pending
+                pending = next(overlay, None)
+            if pending is not None and pending[0] == key:
+                yield pending
+                pending = next(overlay, None)
+            else:
+                yield key, value
+        while pending is not None:
+            yield pending
+            pending = next(overlay, None)
+
+    def items(self):
+        """all (key, value) pairs, in sorted key order"""
+        if not self._staged:
+            return self._merged(self._dirty)
+        changes = dict(self._dirty)
+        changes.update((key, value) for key, (_, value) in self._staged.items())
+        return self._merged(changes)
+
+    def copy(self) -> Dict[str, Any]:
+        return dict(self.items())
+
+    def update(self, kvdict, seq: Optional[int] = None):
+        """
+        Apply changes that are in the segments.
+        :seq: if given, is the seqno they were written at; it supersedes any staged changes to the same keys up to it.
+        """
+        for key, value in kvdict.items():
+            self._hot.pop(key, None)
+            self._dirty[key] = value
+            if seq is not None and key in self._staged and self._staged[key][0] <= seq:
+                del self._staged[key]
+        if seq is not None:
+            self.written_seq = seq
+        if len(self._dirty) > self.budget:
+            self.checkpoint()
+
+    def stage(self, seq: int, kvdict):
+        """apply changes made at :seq: that aren't in the segments yet"""
+        for key, value in kvdict.items():
+            self._staged[key] = (seq, value)
+
+    def checkpoint(self):
+        """merge the written in-memory changes into a new on-disk index"""
+        logging.debug("checkpointing %d changes into %s", len(self._dirty), self.index.idxfile)
+        old = self.index
+        self.index = CompactIndex.write(self._idxfile, self._datfile, self.written_seq, self._merged(self._dirty))
+        old.close()
+        self._dirty.clear()
+        self._hot.clear()
+
+    def rebase(self, index: CompactIndex):
+        """start over from :index: (and its seq), dropping any changes not yet checkpointed"""
+        self.index.close()
+        self.index = index
+        self.seq = self.written_seq = index.seq
+        self._dirty.clear()
+        self._staged.clear()
+        self._hot.clear()
@@ -0,0 +1,114 @@
+
+import os
+import logging
+from itertools import islice
+from pathlib import Path
+from typing import List, Optional, Iterator
+
+from .lines import count_lines
+from .recovery import read_tail, repair_tail
+
+# rewrite a cursor's commit file once it has this many lines
+COMPACT_AFTER = 1000
+
+
+def _committed(path: Path) -> int:
+    """the last seqno committed in the cursor file at :path: (0 if none).  The file isn't modified."""
+    if not path.exists():
+        return 0
+    seqno = read_tail(path, int)
+    return 0 if seqno is None else seqno
+
+
+class Cursor:
+    """
+    A named, durable position in a log, for a consumer to resume from.
+    Commits are appended to a small file under the log's _cursors directory,
+    which is occasionally compacted down to its last line.  Opening a cursor only reads that file;
+    a torn commit left at its end by a crash is truncated by the next .commit().
+
+        cur = log.cursor('billing', tags=['Invoice'])
+        for batch in cur.batches(100):
+            process(batch)
+            cur.commit()
+    """
+
+    def __init__(self, log, name: str, tags=None):
+        if not name or '/' in name or name.startswith('.'):
+            raise ValueError(f"Invalid cursor name {name!r}")
+        self.log = log
+        self.name = name
+        self.tags = tags
+        self.path = log.dir / '_cursors' / name
+        self.committed = _committed(self.path)
+        # the last seqno handed out by .poll()
+        self.position = self.committed
+        # lines in the commit file, so it's compacted on schedule across reopens
+        self._lines = count_lines(self.path, pool=log.handles) if self.path.exists() else 0
+        # whether .commit() has checked the file for a torn tail yet
+        self._repaired = False
+
+    def poll(self, max_events: int = 100) -> List:
+        """
+        Return up to :max_events: events after the current position, in the form the log's .read() returns them,
+        and advance the position past them.  Nothing is committed.
+        """
+        snap = self.log.snapshot()
+        events = list(islice(self.log.read(self.position + 1, tags=self.tags, snapshot=snap), max_events))
+        if len(events) < max_events:
+            # everything up to the snapshot has been seen, matching or not
+            self.position = max(self.position, snap.seq)
+        elif events:
+            self.position = events[-1][0]
+        return events
+
+    def batches(self, max_events: int = 100) -> Iterator[List]:
+        """keep polling until there's nothing more to read"""
+        while True:
+            events = self.poll(max_events)
+            if not events:
+                return
+            yield events
+
+    def rewind(self):
+        """move the position back to the last committed seqno"""
+        self.position = self.committed
+
+    def commit(self, seqno: Optional[int] = None):
+        """durably record :seqno: (default: the current position) as processed"""
+        seqno = self.position if seqno is None else seqno
+        if not self.path.parent.exists():
+            self.path.parent.mkdir()
+        if not self._repaired:
+            # don't append to a torn commit
+            if self.path.exists() and repair_tail(self.path, int)[0] is not None:
+                self._lines = count_lines(self.path, pool=self.log.handles)
+            self._repaired = True
+        if self._lines >= COMPACT_AFTER:
+            tmp = self.path.with_name('.' + self.name + '.tmp')
+            tmp.write_bytes(f"{seqno}\n".encode('utf8'))
+            os.replace(tmp, self.path)
+            self._lines = 1
+        else:
+            with self.path.open('ab') as f:
+                f.write(f"{seqno}\n".encode('utf8'))
+            self._lines += 1
+        logging.debug("cursor %r committed %r", self.name, seqno)
+        self.committed = seqno
+
+
+def cursor_names(log) -> List[str]:
+    """the names of all the cursors stored with :log:"""
+    cursordir = log.dir / '_cursors'
+    if not cursordir.exists():
+        return []
+    return [ f.name for f in cursordir.iterdir() if not f.name.startswith('.') ]
+
+
+def min_committed(log) -> Optional[int]:
+    """the lowest seqno committed by any of :log:'s cursors, or None if it has none"""
+    cursordir = log.dir / '_cursors'
+    names = cursor_names(log)
+    if not names:
+        return None
+    return min(_committed(cursordir / name) for name in names)
@@ -0,0 +1,91 @@
+
+import os
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import BinaryIO, Tuple
+
+
+class HandlePool:
+    """
+    A size-capped pool of open (read-only, binary) segment file handles, evicted least-recently-used first.
+    Readers don't hold on to handles between reads: each read checks one out, seeks to the
+    reader's own offset, reads, and checks it back in.  So any number of concurrent cursors
+    over any number of files need at most :maxsize: idle descriptors, plus one per read in progress,
+    and reading a hot segment again skips the open().
+
+    An idle handle is only reused if :path: still names the same file (device and inode) it was opened on,
+    so a file that's been removed or replaced is never read through a stale handle.
+    """
+
+    def __init__(self, maxsize: int = 64):
+        self.maxsize = maxsize
+        # path: (handle, (st_dev, st_ino) of the file it's open on)
+        self._idle: 'OrderedDict[Path, Tuple[BinaryIO, Tuple[int, int]]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _checkout(self, path: Path) -> Tuple[BinaryIO, Tuple[int, int]]:
+        with self._lock:
+            idle = self._idle.pop(path, None)
+        if idle is not None:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                idle[0].close()
+                raise
+            if (st.st_dev, st.st_ino) == idle[1]:
+                return idle
+            logging.debug("%s was replaced; reopening it", path)
+            idle[0].close()
+        fh = path.open('rb')
+        st = os.fstat(fh.fileno())
+        return fh, (st.st_dev, st.st_ino)
+
+    def _checkin(self, path: Path, entry: Tuple[BinaryIO, Tuple[int, int]]):
+        evicted = []
+        with self._lock:
+            if path in self._idle:
+                # someone else returned a handle for this file first
+                evicted.append(entry[0])
+            else:
+                self._idle[path] = entry
+            while len(self._idle) > self.maxsize:
+                evicted.append(self._idle.popitem(last=False)[1][0])
+        for old in evicted:
+            old.close()
+
+    def read_at(self, path: Path, pos: int, size: int) -> bytes:
+        """read up to :size: bytes at offset :pos: of the file at :path:"""
+        entry = self._checkout(path)
+        fh = entry[0]
+        try:
+            fh.seek(pos)
+            data = fh.read(size)
+        except BaseException:
+            fh.close()
+            raise
+        self._checkin(path, entry)
+        return data
+
+    def discard(self, path: Path):
+        """close any idle handle on :path:, eg. because it's been truncated or removed"""
+        with self._lock:
+            idle = self._idle.pop(path, None)
+        if idle is not None:
+            idle[0].close()
+
+    def clear(self):
+        """close all the idle handles"""
+        with self._lock:
+            handles, self._idle = [ fh for fh, _ in self._idle.values() ], OrderedDict()
+        logging.debug("closing %d pooled handles", len(handles))
+        for fh in handles:
+            fh.close()
+
+    def __len__(self):
+        return len(self._idle)
+
+
+# for reads that aren't given a pool; each log has its own
+DEFAULT_POOL = HandlePool()
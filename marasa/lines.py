@@ -0,0 +1,87 @@
+
+from pathlib import Path
+from typing import Iterator, Optional
+
+from .handlepool import HandlePool, DEFAULT_POOL
+
+# how much of a segment to read at a time
+BLOCKSIZE = 65536
+
+
+def bounded_lines(path: Path, limit: Optional[int] = None, pool: HandlePool = DEFAULT_POOL,
+                  blocksize: int = BLOCKSIZE) -> Iterator[str]:
+    """
+    Yield the complete lines of the file at :path:, stopping before byte :limit: if it's specified.
+    The file is read through :pool:, a block at a time, so no descriptor is held between blocks.
+    """
+    pos = 0
+    while True:
+        want = blocksize if limit is None else min(blocksize, limit - pos)
+        if want <= 0:
+            return
+        data = pool.read_at(path, pos, want)
+        cut = data.rfind(b'\n') + 1
+        if cut == 0:
+            if len(data) < want or (limit is not None and pos + len(data) >= limit):
+                # the end, in the middle of an unterminated (partial) line
+                return
+            # a line longer than a block
+            blocksize *= 2
+            continue
+        pos += cut
+        for line in data[:cut].split(b'\n')[:-1]:
+            yield line.decode('utf8') + '\n'
+
+
+def count_lines(path: Path, limit: Optional[int] = None, pool: HandlePool = DEFAULT_POOL,
+                blocksize: int = BLOCKSIZE) -> int:
+    """Count the complete lines of the file at :path: (before byte :limit:, if specified), without decoding them"""
+    pos, count = 0, 0
+    while True:
+        want = blocksize if limit is None else min(blocksize, limit - pos)
+        if want <= 0:
+            return count
+        data = pool.read_at(path, pos, want)
+        count += data.count(b'\n')
+        pos += len(data)
+        if len(data) < want:
+            return count
+
+
+def buffer_lines(data: bytes) -> Iterator[str]:
+    """Yield the complete lines in :data:, eg. a segment that's already been read into memory"""
+    lines = data.split(b'\n')
+    # whatever follows the last newline is an unterminated (partial) line, or nothing
+    lines.pop()
+    for line in lines:
+        yield line.decode('utf8') + '\n'
+
+
+def reverse_lines(path: Path, limit: Optional[int] = None, pool: HandlePool = DEFAULT_POOL,
+                  blocksize: int = BLOCKSIZE) -> Iterator[str]:
+    """
+    Yield the lines of the file at :path: last first, reading it backwards a block at a time,
+    so only as much of the file as is consumed is read.
+    If :limit: is specified, only the first :limit: bytes of the file are considered.
+    """
+    pos = path.stat().st_size if limit is None else limit
+    # the start of the earliest line seen so far, which may continue in an earlier block
+    leftover = b''
+    # whether the end of the last complete line has been found yet
+    started = False
+    while pos > 0:
+        size = min(blocksize, pos)
+        pos -= size
+        lines = (pool.read_at(path, pos, size) + leftover).split(b'\n')
+        if not started:
+            if len(lines) == 1:
+                # still inside an unterminated (partial) last line; skip it
+                leftover = b''
+                continue
+            lines.pop()
+            started = True
+        leftover = lines.pop(0)
+        for line in reversed(lines):
+            yield line.decode('utf8') + '\n'
+    if leftover:
+        yield leftover.decode('utf8') + '\n'
@@ -1,9 +1,12 @@
 import re
 import logging
+from itertools import islice, groupby
 from pathlib import Path
-from typing import Union, Optional, TypeVar, Iterable, Tuple
+from typing import Union, Optional, TypeVar, Iterable, Tuple, Dict, List
 
 from .constants import NotFound, NOTFOUND
+from .lines import bounded_lines, reverse_lines
+from .handlepool import HandlePool
 
 YourEventType = TypeVar('YourEventType')
 
@@ -30,6 +33,8 @@ class MonoLog:
         if not self.dir.exists():
             self.dir.mkdir()
         self.segment_size = segment_size
+        # this log's pool of open read handles
+        self.handles = HandlePool()
         self._cur: Datum = NOTFOUND
         self._seq: int = 0
         self.reload()
@@ -39,16 +44,16 @@ class MonoLog:
         """The sequence number.  Non-writable."""
         return self._seq
 
-    def put(self, event: YourEventType) -> int:
+    def put(self, event: str) -> int:
         """
         save the specified event
         return the seqno it was saved at
         """
         self._seq += 1
-        self._write(self._seq, tag, event)
+        self._write(self._seq, event)
         return self._seq
 
-    def get(self, seqno: Optional[int]=None) -> YourEventType:
+    def get(self, seqno: Optional[int]=None) -> Datum:
         """
         return the event at the specified
         :seqno: get value at or before the specified sequence number.  If not specified, get the current value.
@@ -59,10 +64,31 @@ class MonoLog:
             raise ValueError("Sequence numbers are never lower than 1")
         else:
             result = self._read_history(seqno)
-        return self.deserialize(result)
+        return result
+
+    def get_many(self, seqnos: Iterable[int]) -> List[Datum]:
+        """
+        return the events at each of :seqnos:, in the same order; missing ones are NOTFOUND.
+        The seqnos are grouped by segment, and each segment file is read at most once.
+        """
+        seqnos = list(seqnos)
+        if any(s < 1 for s in seqnos):
+            raise ValueError("Sequence numbers are never lower than 1")
+        found: Dict[int, Datum] = {}
+        for seg, group in groupby(sorted(set(seqnos)), key=lambda s: s // self.segment_size):
+            remaining = set(group)
+            last = max(remaining)
+            segfile = self._segfile_for_seg(seg)
+            if not segfile.exists(): continue
+            for seq, data in self._segfile_reader(bounded_lines(segfile, pool=self.handles)):
+                if seq > last:
+                    break
+                if seq in remaining:
+                    found[seq] = data
+        return [ found.get(s, NOTFOUND) for s in seqnos ]
 
     def _segfiles(self):
-        return self.dir.glob('{self.name}.*')
+        return self.dir.glob(f'{self.name}.*')
 
     def _segfile_for_seg(self, seg) -> Path:
         """Segfile for the specified segment.  Note: may not exist"""
@@ -106,7 +132,7 @@ class MonoLog:
         segfile = self._segfile_for_seq()
         if segfile is None:
             return 0
-        for seq, _, data in self._segfile_reader(segfile):
+        for seq, data in self._segfile_reader(bounded_lines(segfile, pool=self.handles)):
             latest, cur = seq, data
         self._cur = cur
         self._seq = latest
@@ -119,10 +145,11 @@ class MonoLog:
 
     @staticmethod
     def _segfile_reader(fh):
+        """(seqno, event) for each line, without its newline"""
         for line in fh:
             seqno, data = line.split(' ', 1)
             logging.debug("segfile returning %r %r", seqno, data)
-            yield int(seqno), data
+            yield int(seqno), data.rstrip('\n')
 
     def _read_history(self, seqno):
         if seqno == self.seq:
@@ -133,12 +160,12 @@ class MonoLog:
         segfile = self._segfile_for_seq(seqno)
         if segfile is None:
             return NOTFOUND
-        with segfile.open() as f:
-            for seq, _, data in self._segfile_reader(f):
-                if seq == seqno:
-                    return data
-                elif seq > seqno:
-                    break
+        for seq, data in self._segfile_reader(bounded_lines(segfile, pool=self.handles)):
+            if seq == seqno:
+                return data
+            elif seq > seqno:
+                break
+        return NOTFOUND
 
     def read(self, start_seqno: int) -> Iterable[Tuple[int, Union[YourEventType, NotFound]]]:
         """
@@ -154,11 +181,10 @@ class MonoLog:
             return
 
         # send the partial segment the staring seqno is in
-        with segfile.open() as f:
-            for seq, data in self._segfile_reader(f):
-                if seq < start_seqno:
-                    continue
-                yield seq, data
+        for seq, data in self._segfile_reader(bounded_lines(segfile, pool=self.handles)):
+            if seq < start_seqno:
+                continue
+            yield seq, data
 
         # now send subsequent segments
         curseg = ( start_seqno // self.segment_size )
@@ -168,11 +194,26 @@ class MonoLog:
             curseg += 1
             segfile = self._segfile_for_seg(curseg)
             if not segfile.exists(): continue
-            with segfile.open() as f:
-                for seq, data in self._segfile_reader(f):
-                    yield seq, data
-
-
-
-
+            for seq, data in self._segfile_reader(bounded_lines(segfile, pool=self.handles)):
+                yield seq, data
 
+    def read_reverse(self, from_seqno: Optional[int] = None, limit: Optional[int] = None) -> Iterable[Tuple[int, str]]:
+        """
+        Return a generator that will return (sequence number, event) tuples, newest first,
+        starting at :from_seqno: (or the latest event if it's None) and going back at most :limit: events.
+        Segments are read from their ends, so only about :limit: records are ever parsed.
+        """
+        if from_seqno is None or from_seqno > self.seq:
+            from_seqno = self.seq
+        elif from_seqno < 0:
+            from_seqno = max(from_seqno + self.seq, 0)
+
+        def _events():
+            for seg in range(from_seqno // self.segment_size, -1, -1):
+                segfile = self._segfile_for_seg(seg)
+                if not segfile.exists(): continue
+                for seq, data in self._segfile_reader(reverse_lines(segfile, pool=self.handles)):
+                    if seq <= from_seqno:
+                        yield seq, data
+
+        return islice(_events(), limit)
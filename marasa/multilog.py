@@ -1,24 +1,47 @@
-import re
+import sys
+import heapq
 import logging
+from bisect import bisect_right
+from collections import OrderedDict
+from itertools import accumulate, chain, islice, groupby, takewhile
 from pathlib import Path
-from typing import Union, Optional, Dict, List, TypeVar, Tuple, Iterable
+from typing import Union, Optional, Dict, List, TypeVar, Tuple, Iterable, Callable, Any
 
 from .mixins import AsyncSafeLogMixin, ThreadSafeLogMixin
 from .constants import NOTFOUND, NotFound
+from .columnar import ColumnBatch, FieldSpec, fill_columns
+from .recovery import RecoveryReport, repair_tail
+from .snapshot import Snapshot
+from .lines import bounded_lines, buffer_lines, count_lines
+from .prefetch import Prefetcher, MAX_BYTES
+from .cursor import Cursor, cursor_names, min_committed
+from .handlepool import HandlePool
+from .secondary import SecondaryIndex
+from .codec import Codec, find_codec
+from .tagregistry import TagRegistry
 
 # Placeholder for the user's event data
 YourEventType = TypeVar('YourEventType')
 
 # serialized data
-Datum = Union[NotFound, str]
+Datum = Union[NotFound, str, bytes]
+
+# a stored event: (seqno, tag, data)
+Record = Tuple[int, str, Union[str, bytes]]
 
 class MultiLog:
     """
     MultiLog stores a series of events, in a set of logfiles that are partitioned by tag
-    The logfiles are segmented so each has at most :segment_size: lines.
-    Each line consists of a sequence number, a space, the tag, another space, and the serialized event
+    The logfiles are segmented so each has at most :segment_size: records.
+    Each logfile starts with a header line of '#v2 ' and the tag, and then each line consists
+    of a sequence number, a space, and the serialized event.
+    Logfiles without a header are the original format, where each line consists of a sequence number,
+    a space, the tag, another space, and the serialized event; these are still read.
     """
 
+    # header for segments that store the tag once, instead of on every line
+    V2_HEADER = '#v2 '
+
     NOTFOUND = NOTFOUND
 
     def __init__(self, storage_dir: Union[Path, str], segment_size: int = 10000):
@@ -32,8 +55,18 @@ class MultiLog:
         if not self.dir.exists():
             self.dir.mkdir()
         self.segment_size = segment_size
+        # this log's pool of open read handles
+        self.handles = HandlePool()
         # self._cur is a dict of tag: (seqno, msg), so we can find most recent of any tag easily
         self._cur: Dict[str, Tuple[int, Datum]] = dict()
+        # self._visible is the completely-written length of each segfile in the current segment,
+        # and in the one before it; self._rolls counts the times a new segment was started
+        self._visible: Dict[Path, int] = dict()
+        self._rolls = 0
+        # self._headers is the header tag (or None for original format) of segfiles in the current segment
+        self._headers: Dict[Path, Optional[str]] = dict()
+        # the known tags, so they needn't be globbed for on every read
+        self._registry = TagRegistry(self._scan_tags)
         self._seq: int = 0
         self.reload()
 
@@ -58,38 +91,98 @@ class MultiLog:
         self._write(seq, tag, event)
         return seq
 
-    def get(self, tags: Optional[List[str]] = None, seqno: Optional[int] = None) -> Union[YourEventType, NotFound]:
+    def snapshot(self) -> Snapshot:
+        """
+        Pin the current seqno and segment lengths, returning a Snapshot whose .read() and .get()
+        see exactly the records up to that seqno, regardless of concurrent writes.
+        """
+        # _write updates _visible before _cur, so copying _cur first means every record it
+        # mentions is covered by the copied lengths, as long as _visible still has the lengths for
+        # the segment _cur was in; it keeps them through one new segment, so retry after two.
+        while True:
+            rolls = self._rolls
+            cur = dict(self._cur)
+            visible = dict(self._visible)
+            if self._rolls - rolls <= 1:
+                return Snapshot(self, cur, visible)
+
+    def get(self, tags: Optional[List[str]] = None, seqno: Optional[int] = None,
+            snapshot: Optional[Snapshot] = None) -> Union[YourEventType, NotFound]:
         """
         Fetch an event
         :tags: limit the events to those with one of these tags.  If unspecified, any will do.
         :seqno: get value at or before the specified sequence number.  If unspecified, get the current value
+        :snapshot: read as of this Snapshot; if unspecified, a fresh one is taken
         if no event matches, return NOTFOUND
         """
+        record = self._get_record(tags, seqno, snapshot)
+        if isinstance(record, NotFound):
+            return NOTFOUND
+        return record[2]
+
+    def _get_record(self, tags: Optional[List[str]], seqno: Optional[int],
+                    snapshot: Optional[Snapshot]) -> Union[Record, NotFound]:
+        """like .get(), but return the whole (seqno, tag, data) record"""
+        snap = self.snapshot() if snapshot is None else snapshot
         msgtags = self._tags() if tags is None else tags
         if seqno is None:
-            result = self._get_cur(msgtags)
-        elif seqno < 1:
+            return snap.latest_record(msgtags)
+        if seqno < 1:
             raise ValueError("Sequence numbers are never lower than 1")
+        return self._get_history(msgtags, seqno, snap)
+
+    @classmethod
+    def _segfile_reader(cls, fh):
+        lines = iter(fh)
+        first = next(lines, None)
+        if first is None:
+            return
+        if first.startswith(cls.V2_HEADER):
+            # one tag object for the whole segment
+            tag = sys.intern(first[len(cls.V2_HEADER):].rstrip('\n'))
+            line = next(lines, None)
+            # skip any further header lines
+            while line is not None and line.startswith('#'):
+                line = next(lines, None)
+            if line is None:
+                return
+            for line in chain((line,), lines):
+                seqno, jdata = line.split(' ', 1)
+                yield int(seqno), tag, jdata
         else:
-            result = self._get_history(msgtags, seqno)
-        if isinstance(result, NotFound):
-            return NOTFOUND
-        return result
-
-    @staticmethod
-    def _segfile_reader(fh):
-        for line in fh:
-            seqno, tag, jdata = line.split(' ', 2)
-            #logging.debug("segfile returning %r %r %r", seqno, tag, jdata)
-            yield int(seqno), tag, jdata
+            for line in chain((first,), lines):
+                seqno, tag, jdata = line.split(' ', 2)
+                #logging.debug("segfile returning %r %r %r", seqno, tag, jdata)
+                yield int(seqno), sys.intern(tag), jdata
+
+    def _segfile_reverse_reader(self, segfile: Path, lines):
+        """like _segfile_reader, but for a segment's lines in reverse order"""
+        tag = self._segfile_header(segfile)
+        if tag is not None:
+            tag = sys.intern(tag)
+        for line in lines:
+            if line.startswith('#'):
+                # the header; the first line of the file
+                return
+            yield self._parse_line(line, tag)
+
+    def _segfile_header(self, segfile: Path) -> Optional[str]:
+        """the tag from the segfile's header, or None if it's in the original format (or empty)"""
+        first = next(bounded_lines(segfile, pool=self.handles, blocksize=256), '')
+        if first.startswith(self.V2_HEADER) and first.endswith('\n'):
+            return first[len(self.V2_HEADER):-1]
+        return None
 
     def _segfiles(self, tag=None):
         prefix = '*' if tag is None else tag
         return self.dir.glob(f'{prefix}.*')
 
-    def _tags(self):
+    def _scan_tags(self):
         return set(f.name.rsplit('.', 1)[0] for f in self._segfiles())
 
+    def _tags(self):
+        return self._registry.tags()
+
     def _segfile_for_seqno(self, tag: str, seq: Optional[int]=None) -> Optional[Path]:
         """
         find the segment file to open to get the state as of seqno=seq.
@@ -110,73 +203,172 @@ class MultiLog:
                 biggest = (fileseg, f)
         return biggest[1]
 
-    def _tail_tagseg(self, tag: str):
-        """Return a tuple of the last seqno and the latest data for the specified tag"""
-        seqno, last = 0, NOTFOUND
-        segfile = self._segfile_for_seqno(tag, None)
-        if segfile is not None:
-            with segfile.open() as f:
-                *_, (seqno, _, last) = self._segfile_reader(f)
-        return seqno, last
-
-    def reload(self):
-        latest = {}
-        for t in self._tags():
-            seqno, data = self._tail_tagseg(t)
-            if seqno > latest[t][0]:
-                latest[t] = (seqno, data)
+    @staticmethod
+    def _parse_line(line: str, tag: Optional[str] = None) -> Tuple[int, str, str]:
+        """
+        parse a single (newline-stripped) record; raises ValueError if it's malformed
+        :tag: is the segment header's tag, or None if the segment is in the original format
+        """
+        if tag is not None:
+            seqno, data = line.split(' ', 1)
+        else:
+            seqno, tag, data = line.split(' ', 2)
+        return int(seqno), tag, data
+
+    def _tail_tagseg(self, tag: str, report: RecoveryReport):
+        """
+        Return a tuple of the last seqno and the latest data for the specified tag,
+        repairing the tail of its active segment if need be.  Only the end of the segment is read.
+        """
+        def parser(header):
+            def parse(line):
+                seqno, linetag, data = self._parse_line(line.rstrip('\n'), header)
+                if linetag != tag:
+                    raise ValueError(f"record for tag {linetag!r} in a segment for {tag!r}")
+                return seqno, data
+            return parse
+
+        segfiles = sorted(self._segfiles(tag), key=lambda f: int(f.name.split('.')[-1]), reverse=True)
+        for segfile in segfiles:
+            # a lone header line won't parse as a record, so a segment with no records is emptied
+            repair, parsed = repair_tail(segfile, parser(self._segfile_header(segfile)))
+            if repair is not None:
+                report.repairs.append(repair)
+                self.handles.discard(segfile)
+            if parsed is None:
+                # nothing valid left in it; fall back to the previous segment
+                segfile.unlink()
+                continue
+            seqno, data = parsed
+            if seqno // self.segment_size != int(segfile.name.split('.')[-1]):
+                report.problems.append(f"{segfile.name} ends with seqno {seqno}, which belongs in another segment")
+            return seqno, data
+        return 0, NOTFOUND
+
+    def reload(self) -> RecoveryReport:
+        """
+        Rebuild the in-memory state from the tails of each tag's active segment,
+        repairing any torn records found there.
+        Returns the RecoveryReport, which is also kept as .recovery
+        """
+        report = RecoveryReport()
+        latest: Dict[str, Tuple[int, Datum]] = {}
+        owners: Dict[int, str] = {}
+        for t in self._scan_tags():
+            seqno, data = self._tail_tagseg(t, report)
+            if seqno == 0:
+                continue
+            if seqno in owners:
+                report.problems.append(f"seqno {seqno} is the last record of both {owners[seqno]!r} and {t!r}")
+            owners[seqno] = t
+            latest[t] = (seqno, data)
+        self._visible = { f: f.stat().st_size for f in
+                          (self._segfile_for_seg(t, latest[t][0] // self.segment_size) for t in latest) }
         self._cur = latest
+        # recovery may have removed a tag's only segment
+        self._registry.reset()
         self._seq = max(latest[t][0] for t in latest) if latest else 0
+        self.recovery = report
+        return report
 
     def _segfile_for_seg(self, tag, seg) -> Path:
         """Segfile for the specified segment.  None if it doesn't exist."""
         return self.dir / f"{tag}.{seg:09}"
 
+    def _segment_header(self, tag: str) -> str:
+        """the header lines to start a new segment for :tag: with"""
+        return f"{self.V2_HEADER}{tag}\n"
+
     def _write(self, seqno: int, tag: str, data):
         """write to a single file
         """
         # figure out the file to write to
-        segfile = self._segfile_for_seg(tag, seqno // self.segment_size)
-        mode = 'a' if segfile.exists() else 'w'
-        # write it out
-        with segfile.open(mode) as f:
-            dataline = f"{seqno!s} {tag} {data}\n"
-            f.write(dataline)
+        seg = seqno // self.segment_size
+        segfile = self._segfile_for_seg(tag, seg)
+        if (seqno - 1) // self.segment_size != seg:
+            # new segment; keep the lengths of the last one for snapshots whose _cur is still in it
+            last = f".{(seqno - 1) // self.segment_size:09}"
+            self._rolls += 1
+            self._visible = { f: size for f, size in self._visible.items() if f.name.endswith(last) }
+            self._headers = {}
+        if segfile not in self._headers:
+            if segfile.exists() and segfile.stat().st_size:
+                self._headers[segfile] = self._segfile_header(segfile)
+            else:
+                with segfile.open('wb') as f:
+                    f.write(self._segment_header(tag).encode('utf8'))
+                self._headers[segfile] = tag
+                self._registry.add(tag)
+        # write it out; data may already be encoded
+        payload = data if isinstance(data, bytes) else data.encode('utf8')
+        with segfile.open('ab') as f:
+            if self._headers[segfile] is None:
+                prefix = f"{seqno!s} {tag} "
+            else:
+                prefix = f"{seqno!s} "
+            f.write(prefix.encode('utf8') + payload + b'\n')
+            size = f.tell()
         logging.debug("wrote tag %r event %r as seqno %r", tag, data, seqno)
+        # publish the new length before the new record; see .snapshot()
+        self._visible[segfile] = size
         self._cur[tag] = (seqno, data)
 
-    def _get_cur(self, tags: Optional[List[str]]) -> Datum:
-        if not self._cur:
-            logging.debug("_cur unset, reloading")
-            self.reload()
-        if not self._cur:
-            logging.debug("_cur unset after reload; empty db. NOTFOUND")
-            return NOTFOUND
-        if tags is None:
-            which = max(self._cur.values(), key=lambda e: e[0])
-            logging.debug("most recent of all _cur is %r)", which)
-        else:
-            which = max((self._cur[t] for t in tags), key=lambda e:e[0])
-            logging.debug("most recent of allowed _cur is %r)", which)
-        return which[1]
-
-    def _get_history(self, tags: Optional[List[str]], seqno: int) -> Datum:
+    def _get_history(self, tags: Optional[List[str]], seqno: int, snap: Snapshot) -> Union[Record, NotFound]:
         msgtags = self._tags() if tags is None else tags
         logging.debug("looking in history of %r (%r)", tags, msgtags)
+        if seqno > snap.seq:
+            return NOTFOUND
         # read from a point in history
+        seg = seqno // self.segment_size
         for t in msgtags:
-            segfile = self._segfile_for_seqno(t, seqno)
-            if segfile is None: continue
+            segfile = self._segfile_for_seg(t, seg)
+            if not segfile.exists(): continue
             logging.debug("history of tag %r in segfile %s", t, segfile)
-            with segfile.open() as f:
-                for seq, _, data in self._segfile_reader(f):
-                    if seq > seqno:
-                        break
-                    if seq == seqno:
-                        return data
+            for seq, _, data in self._segfile_reader(snap.lines(segfile, seg)):
+                if seq > seqno:
+                    break
+                if seq == seqno:
+                    return seq, t, data
         return NOTFOUND # if that seqno is missing
 
-    def read(self, start_seqno: int, end_seqno: int = None, tags: Optional[List[str]] = None) -> Iterable[Tuple[int, Union[YourEventType, NotFound]]]:
+    def get_many(self, seqnos: Iterable[int], tags: Optional[List[str]] = None,
+                 snapshot: Optional[Snapshot] = None) -> List[Datum]:
+        """
+        Fetch the events at each of :seqnos:, returning them in the same order; missing ones are NOTFOUND.
+        :tags: limit the events to those with one of these tags.  If unspecified, any will do.
+        The seqnos are grouped by segment, and each segment file is read at most once.
+        """
+        return [ NOTFOUND if isinstance(r, NotFound) else r[2] for r in self._get_many_records(seqnos, tags, snapshot) ]
+
+    def _get_many_records(self, seqnos: Iterable[int], tags: Optional[List[str]],
+                          snapshot: Optional[Snapshot]) -> List[Union[Record, NotFound]]:
+        """like .get_many(), but return whole (seqno, tag, data) records"""
+        seqnos = list(seqnos)
+        if any(s < 1 for s in seqnos):
+            raise ValueError("Sequence numbers are never lower than 1")
+        snap = self.snapshot() if snapshot is None else snapshot
+        msgtags = self._resolve_tags(tags)
+        found: Dict[int, Record] = {}
+        wanted = sorted(set(s for s in seqnos if s <= snap.seq))
+        for seg, group in groupby(wanted, key=lambda s: s // self.segment_size):
+            remaining = set(group)
+            last = max(remaining)
+            for t in msgtags:
+                segfile = self._segfile_for_seg(t, seg)
+                if not segfile.exists(): continue
+                for seq, _, data in self._segfile_reader(snap.lines(segfile, seg)):
+                    if seq > last:
+                        break
+                    if seq in remaining:
+                        found[seq] = (seq, t, data)
+                        remaining.discard(seq)
+                if not remaining:
+                    break
+        return [ found.get(s, NOTFOUND) for s in seqnos ]
+
+    def read(self, start_seqno: int, end_seqno: Optional[int] = None, tags: Optional[List[str]] = None,
+             snapshot: Optional[Snapshot] = None, prefetch: int = 0,
+             prefetch_bytes: int = MAX_BYTES) -> Iterable[Record]:
         """
         Return a generator that will return tuples (seqno, tag, data)
         If tags is a list, the events must have one of those tags.
@@ -184,61 +376,237 @@ class MultiLog:
         If tags is None or unspecified, all events are returned.
         If start_seqno is negative, it will be interpreted as 'from the (current) end'
         If end_eqno is None (the default) it will be interpreted to mean 'all (currently existing) events'
+        If snapshot is None (the default) a snapshot is taken when the read starts, so events written
+        while iterating are never returned.
+        If prefetch is nonzero, a background thread reads that many segments ahead (holding at most
+        prefetch_bytes of them) while the current one is parsed.
         """
+        snap = self.snapshot() if snapshot is None else snapshot
 
         def _existing_segfiles(tags, segno):
             for tag in tags:
                 segfile = self._segfile_for_seg(tag, segno)
                 if segfile.exists():
                     yield tag, segfile
+
+        def _segment_lines(segs):
+            """for each segment, a dict of tag: lines"""
+            if not prefetch:
+                for seg in segs:
+                    yield { tag: snap.lines(f, seg) for tag, f in _existing_segfiles(msgtags, seg) }
+                return
+            jobs = ( [ (tag, f, snap.limit(f, seg)) for tag, f in _existing_segfiles(msgtags, seg) ] for seg in segs )
+            prefetcher = Prefetcher(jobs, self.handles, depth=prefetch, max_bytes=prefetch_bytes)
+            try:
+                for segdata in prefetcher:
+                    yield { tag: buffer_lines(data) for tag, data in segdata.items() }
+            finally:
+                prefetcher.close()
+
         if start_seqno < 0:
-            start_seqno = max(start_seqno + self.seq, 0)
+            start_seqno = max(start_seqno + snap.seq, 0)
+        end_seqno = snap.seq if end_seqno is None else min(end_seqno, snap.seq)
+        msgtags = self._resolve_tags(tags)
+        segments = _segment_lines(range(start_seqno // self.segment_size, snap.seg + 1))
+        try:
+            for curseg, seglines in enumerate(segments, start_seqno // self.segment_size):
+                cursors = { tag: self._segfile_reader(lines) for tag, lines in seglines.items() }
+                latest = { k: v for k, v in  { tag: next(cursors[tag], None) for tag in cursors }.items() if v is not None }
+                while latest:
+                    logging.debug("segment %s: %r", curseg, latest)
+                    seq, tag, data = min(latest.values(), key=lambda i: i[0])
+                    if seq > end_seqno:
+                        return
+                    latest[tag] = next(cursors[tag], None)
+                    if latest[tag] is None:
+                        del latest[tag]
+                        del cursors[tag]
+                    if seq < start_seqno:
+                        continue
+                    yield seq, tag, data
+        finally:
+            segments.close()
+
+    def _resolve_tags(self, tags):
+        """
+        The tags :tags: refers to: if it's a string, it's a regex that the tags must match;
+        if it's None, it's all of them.  Both come from the tag registry, without scanning the directory.
+        """
         if isinstance(tags, str):
-            pattern = re.compile(tags)
-            msgtags = [ tag for tag in self._tags() if pattern.fullmatch(tag) ]
-        else:
-            msgtags = self._tags() if tags is None else tags
-        curseg = ( start_seqno // self.segment_size )
-        while curseg < self.seq // self.segment_size:
-            cursors = { tag: self._segfile_reader(f.open()) for tag, f in _existing_segfiles(msgtags, curseg) }
-            latest = { k: v for k, v in  { tag: next(cursors[tag], None) for tag in cursors }.items() if v is not None }
-            while cursors:
-                logging.debug("segment %s: %r", curseg, latest)
-                seq, tag, data = min(latest.values(), key=lambda i: i[0])
-                if end_seqno is not None and seq > end_seqno:
-                    return
-                latest[tag] = next(cursors[tag], None)
-                if latest[tag] is None:
-                    del latest[tag]
-                    del cursors[tag]
-                yield seq, tag, data
-            curseg += 1
-
-    def slice(self, tags=None):
+            return self._registry.matching(tags)
+        return self._tags() if tags is None else tags
+
+    def read_reverse(self, from_seqno: Optional[int] = None, tags: Optional[List[str]] = None,
+                     limit: Optional[int] = None, snapshot: Optional[Snapshot] = None) -> Iterable[Record]:
+        """
+        Return a generator of tuples (seqno, tag, data) like .read(), but newest first.
+        :from_seqno: the seqno to start at (and go backwards from); if None, the latest.
+        If negative, it will be interpreted as 'from the (current) end'
+        :tags: as with .read()
+        :limit: return at most this many events
+        Segments are read from their ends, so only about :limit: records are ever parsed.
+        """
+        snap = self.snapshot() if snapshot is None else snapshot
+        if from_seqno is None or from_seqno > snap.seq:
+            from_seqno = snap.seq
+        elif from_seqno < 0:
+            from_seqno = max(from_seqno + snap.seq, 0)
+        msgtags = self._resolve_tags(tags)
+
+        def _events():
+            for seg in range(from_seqno // self.segment_size, -1, -1):
+                segfiles = [ self._segfile_for_seg(tag, seg) for tag in msgtags ]
+                cursors = [ self._segfile_reverse_reader(f, snap.reverse_lines(f, seg)) for f in segfiles if f.exists() ]
+                for seq, tag, data in heapq.merge(*cursors, key=lambda e: e[0], reverse=True):
+                    if seq <= from_seqno:
+                        yield seq, tag, data
+
+        return islice(_events(), limit)
+
+    def read_columns(self, start_seqno: int, end_seqno: Optional[int] = None, tags: Optional[List[str]] = None) -> ColumnBatch:
+        """
+        Like .read(), but return the whole range as a ColumnBatch: seqnos as an int64 array,
+        tags dictionary-encoded, and the payloads as offsets into one contiguous buffer.
+        """
+        batch = ColumnBatch()
+        append = batch.append
+        # call MultiLog.read explicitly, since subclasses change its signature
+        for seq, tag, data in MultiLog.read(self, start_seqno, end_seqno, tags=tags):
+            if isinstance(data, str):
+                data = data.encode('utf8')
+            append(seq, tag, data.rstrip(b'\n'))
+        return batch.finish()
+
+    def slice(self, tags=None) -> 'MultiLogSlice':
+        """
+        Return a MultiLogSlice: a lazy sequence of the events with the specified tags (as with .read()),
+        that can be indexed, sliced, and measured with len() without reading every event.
+        """
         return MultiLogSlice(self, tags)
 
+    def _slice_item(self, seqno: int, tag: str, data: Union[str, bytes]):
+        """what a MultiLogSlice returns for a record"""
+        return seqno, tag, data
+
+    def cursor(self, name: str, tags=None) -> Cursor:
+        """
+        Return the named durable Cursor, which reads events with the specified tags
+        and resumes from wherever it last committed.
+        """
+        return Cursor(self, name, tags)
+
+    def cursors(self) -> List[str]:
+        """the names of the existing cursors"""
+        return cursor_names(self)
+
+    def min_committed_seqno(self) -> Optional[int]:
+        """
+        The lowest seqno committed by any cursor, or None if there are no cursors.
+        Segments wholly before this are no longer needed by any consumer.
+        """
+        return min_committed(self)
+
 
 
 class MultiLogSlice:
+    """
+    A lazy, read-only sequence of the events with the specified tags (or all of them), in seqno order,
+    as (seqno, tag, data) for a MultiLog and (seqno, event) for a SerializingMultiLog.
+
+        page = log.slice(tags=['Order'])[-20:]
+
+    Positions are found from per-segment record counts, so indexing or slicing reads only the
+    segments holding the wanted records, each at most once per call.  The counts of segments no
+    longer being written to, and the records of the last few of them read, are kept for later calls.
+    Each call sees the log as of a fresh snapshot; slicing returns a list.
+    """
+
+    # how many segments' records to keep
+    CACHED_SEGMENTS = 4
 
     def __init__(self, db, tags):
         self.db = db
         self.tags = tags
+        self._tagkey: Tuple[str, ...] = ()
+        # record counts of the segments before self._sealed
+        self._counts: List[int] = []
+        self._segments: 'OrderedDict[int, List[Record]]' = OrderedDict()
+
+    def _prepare(self, snap: Snapshot) -> Tuple[Tuple[str, ...], List[int]]:
+        """the tags to read, and the cumulative record counts of each segment up to the snapshot's"""
+        tags = tuple(sorted(self.db._resolve_tags(self.tags)))
+        if tags != self._tagkey:
+            self._tagkey, self._counts, self._segments = tags, [], OrderedDict()
+        while len(self._counts) < snap.seg:
+            self._counts.append(self._count(tags, len(self._counts), snap))
+        counts = self._counts + [ self._count(tags, snap.seg, snap) ]
+        return tags, list(accumulate(counts))
+
+    def _count(self, tags: Tuple[str, ...], seg: int, snap: Snapshot) -> int:
+        """how many records the segment has among :tags:"""
+        if self.tags is None:
+            # every seqno is some tag's event
+            first, last = max(seg * self.db.segment_size, 1), min((seg + 1) * self.db.segment_size - 1, snap.seq)
+            return max(last - first + 1, 0)
+        total = 0
+        for tag in tags:
+            segfile = self.db._segfile_for_seg(tag, seg)
+            if not segfile.exists(): continue
+            limit = snap.limit(segfile, seg)
+            headers = takewhile(lambda line: line.startswith('#'), bounded_lines(segfile, limit, pool=self.db.handles, blocksize=256))
+            total += count_lines(segfile, limit, pool=self.db.handles) - sum(1 for _ in headers)
+        return total
+
+    def _records(self, tags: Tuple[str, ...], seg: int, snap: Snapshot, loaded: Dict[int, List[Record]]) -> List[Record]:
+        """
+        the segment's records among :tags:, in seqno order
+        :loaded: holds the segments read as of :snap:, so each is read at most once per call,
+        even the one still being written to
+        """
+        records = self._segments.get(seg)
+        if records is not None:
+            self._segments.move_to_end(seg)
+            return records
+        records = loaded.get(seg)
+        if records is not None:
+            return records
+        segfiles = [ (tag, self.db._segfile_for_seg(tag, seg)) for tag in tags ]
+        cursors = [ self.db._segfile_reader(snap.lines(f, seg)) for _, f in segfiles if f.exists() ]
+        records = loaded[seg] = list(heapq.merge(*cursors, key=lambda r: r[0]))
+        if seg < snap.seg:
+            # it won't change any more
+            self._segments[seg] = records
+            while len(self._segments) > self.CACHED_SEGMENTS:
+                self._segments.popitem(last=False)
+        return records
+
+    def _item(self, tags: Tuple[str, ...], cumulative: List[int], snap: Snapshot, i: int, loaded: Dict[int, List[Record]]):
+        seg = bisect_right(cumulative, i)
+        before = cumulative[seg - 1] if seg else 0
+        return self.db._slice_item(*self._records(tags, seg, snap, loaded)[i - before])
+
+    def __len__(self) -> int:
+        return self._prepare(self.db.snapshot())[1][-1]
 
     def __getitem__(self, key):
-        if isinstance(key, int):
-            return self.db.get(tags=self.tags, seqno=key)
+        snap = self.db.snapshot()
+        tags, cumulative = self._prepare(snap)
+        length = cumulative[-1]
+        loaded: Dict[int, List[Record]] = {}
         if isinstance(key, slice):
-            retgen = self.db.read(start_seqno=key.start, end_seqno=key.stop, tags=self.tags)
-            if key.step is None:
-                yield from retgen
-            else:
-                for i, retval in retgen:
-                    if i % key.step == 0:
-                        yield retval
-
-
+            return [ self._item(tags, cumulative, snap, i, loaded) for i in range(*key.indices(length)) ]
+        if not isinstance(key, int):
+            raise TypeError(f"{self.__class__.__name__} indices must be integers or slices, not {type(key).__name__}")
+        i = key + length if key < 0 else key
+        if not 0 <= i < length:
+            raise IndexError(f"{self.__class__.__name__} index out of range")
+        return self._item(tags, cumulative, snap, i, loaded)
 
+    def __iter__(self):
+        snap = self.db.snapshot()
+        tags = list(self.db._resolve_tags(self.tags))
+        for seq, tag, data in MultiLog.read(self.db, 1, tags=tags, snapshot=snap):
+            yield self.db._slice_item(seq, tag, data)
 
 
 Taimo = MultiLog
@@ -255,17 +623,83 @@ class SerializingMultiLog(MultiLog):
             generated tuples are (seqno, tag, event) or (seqno, event)
         .get() and .read() accept lists of objects as well as strings, and those objects' __name__s are
             used as the tag names to match
+
+    It can also maintain secondary indexes on fields of the events; see .add_index() and .lookup()
+
+    Tags can be given their own Codecs.  A segment written with a codec has a '#codec ' header line
+    naming it, and is always read back with that codec, even if the tag's codec has since changed.
     """
 
-    def __init__(self, storage_dir: Union[Path, str], serializer, deserializer, segment_size: int = 10000):
+    # header for segments written with a codec, rather than the serializer/deserializer
+    CODEC_HEADER = '#codec '
+
+    def __init__(self, storage_dir: Union[Path, str], serializer, deserializer, segment_size: int = 10000,
+                 indexes: Optional[Dict[str, Callable]] = None, codecs: Optional[Dict[str, Codec]] = None):
         """
         :storage_dir: is the directory to store log files in
         :segment_size: is how many records to store per file; the default is 10000,
         so if average change size is 1KB, that's a 10MB file
+        :indexes: a dict of index name: extractor function, as for .add_index()
+        :codecs: a dict of tag: Codec for the tags whose events shouldn't use serializer/deserializer
         """
+        self.codecs: Dict[str, Codec] = dict(codecs or {})
+        # the codec (or None, for serializer/deserializer) of each (tag, seg) that's been looked at
+        self._segcodecs: Dict[Tuple[str, int], Optional[Codec]] = {}
         super().__init__(storage_dir, segment_size=segment_size)
         self.serialize = serializer
         self.deserialize = deserializer
+        self.indexes: Dict[str, SecondaryIndex] = {}
+        for name, extractor in (indexes or {}).items():
+            self.add_index(name, extractor)
+
+    def add_index(self, name: str, extractor: Callable[[YourEventType], Any]) -> SecondaryIndex:
+        """
+        Maintain an index of the value :extractor: returns for each event (or None, to not index it).
+        Any events not yet in the index are indexed now.
+        """
+        self.indexes[name] = SecondaryIndex(self, name, extractor)
+        return self.indexes[name]
+
+    def lookup(self, name: str, value, with_events: bool = False) -> Iterable:
+        """
+        Yield the seqnos of the events whose :name: index value is :value:, in order,
+        or (seqno, event) tuples if :with_events: is true.
+        """
+        if not with_events:
+            yield from self.indexes[name].lookup(value)
+            return
+        seqnos = list(self.indexes[name].lookup(value))
+        yield from zip(seqnos, self.get_many(seqnos))
+
+    def reload(self) -> RecoveryReport:
+        self._segcodecs = {}
+        return super().reload()
+
+    def _segment_header(self, tag: str) -> str:
+        header = super()._segment_header(tag)
+        codec = self.codecs.get(tag)
+        return header if codec is None else f"{header}{self.CODEC_HEADER}{codec.name}\n"
+
+    def _seg_codec(self, tag: str, seg: int) -> Optional[Codec]:
+        """the codec segment :seg: of :tag: is (or will be) written with; None means serializer/deserializer"""
+        key = (tag, seg)
+        if key in self._segcodecs:
+            return self._segcodecs[key]
+        segfile = self._segfile_for_seg(tag, seg)
+        headers = list(islice(bounded_lines(segfile, pool=self.handles, blocksize=256), 2)) if segfile.exists() else []
+        if not headers:
+            # not written yet; it will be with the tag's current codec
+            return self.codecs.get(tag)
+        codec = None
+        if headers[0].startswith(self.V2_HEADER) and len(headers) > 1 and headers[1].startswith(self.CODEC_HEADER):
+            configured = { c.name: c for c in self.codecs.values() }
+            codec = find_codec(headers[1][len(self.CODEC_HEADER):-1], configured)
+        self._segcodecs[key] = codec
+        return codec
+
+    def _decode(self, seqno: int, tag: str, data: Union[bytes, str]):
+        codec = self._seg_codec(tag, seqno // self.segment_size)
+        return self.deserialize(data) if codec is None else codec.decode(data)
 
     def put(self, event, tag=None) -> int:
         """
@@ -274,8 +708,12 @@ class SerializingMultiLog(MultiLog):
         Return the seqno it was saved at.
         """
         if tag is None: tag = event.__class__.__name__
-        data = self.serialize(event)
-        return super().put(data, tag)
+        codec = self._seg_codec(tag, (self.seq + 1) // self.segment_size)
+        data = self.serialize(event) if codec is None else codec.encode(event)
+        seqno = super().put(data, tag)
+        for index in self.indexes.values():
+            index.add(seqno, event)
+        return seqno
 
     @staticmethod
     def _xlate_tags(taglist):
@@ -292,27 +730,71 @@ class SerializingMultiLog(MultiLog):
                 msgtags.append(tag.__name__)
         return msgtags
 
-    def get(self, tags: Optional[List[str]] = None, seqno: Optional[int] = None) -> Union[YourEventType, NotFound]:
+    def get(self, tags: Optional[List[str]] = None, seqno: Optional[int] = None,
+            snapshot: Optional[Snapshot] = None) -> Union[YourEventType, NotFound]:
         """
         Fetch an event
         :tags: limit the events to those with one of these tags.  If unspecified, any will do.
         If the list is not of strings, the tags will be their .__name__s (so passing in classes will work)
         :seqno: get value at or before the specified sequence number.  If unspecified, get the current value
+        :snapshot: read as of this Snapshot; if unspecified, a fresh one is taken
         if no event matches, return NOTFOUND
         """
+        record = self._get_record(self._xlate_tags(tags), seqno, snapshot)
+        if isinstance(record, NotFound):
+            return NOTFOUND
+        return self._decode(*record)
+
+    def get_many(self, seqnos: Iterable[int], tags: Optional[List[str]] = None,
+                 snapshot: Optional[Snapshot] = None) -> List[Any]:
+        """
+        Fetch the events at each of :seqnos:, in the same order; missing ones are NOTFOUND.
+        :tags: as with .get()
+        """
+        records = self._get_many_records(seqnos, self._xlate_tags(tags), snapshot)
+        return [ NOTFOUND if isinstance(r, NotFound) else self._decode(*r) for r in records ]
+
+    def read(self, start_seqno: int, tags: Optional[List[str]] = None, with_tags: bool = False,
+             snapshot: Optional[Snapshot] = None, prefetch: int = 0,
+             prefetch_bytes: int = MAX_BYTES) -> Iterable[Tuple]:
         msgtags = self._xlate_tags(tags)
-        result = super().get(tags=msgtags, seqno=seqno)
-        if result == NOTFOUND:
-            return result
-        return self.deserialize(result)
+        for seq, tag, data in super().read(start_seqno, tags=msgtags, snapshot=snapshot,
+                                           prefetch=prefetch, prefetch_bytes=prefetch_bytes):
+            if with_tags:
+                yield seq, tag, self._decode(seq, tag, data)
+            else:
+                yield seq, self._decode(seq, tag, data)
 
-    def read(self, start_seqno: int, tags: Optional[List[str]] = None, with_tags: bool = False) -> Iterable[Tuple[int, Union[YourEventType, NotFound]]]:
+    def slice(self, tags=None) -> MultiLogSlice:
+        return MultiLogSlice(self, tags if isinstance(tags, str) else self._xlate_tags(tags))
+
+    def _slice_item(self, seqno: int, tag: str, data: Union[str, bytes]):
+        return seqno, self._decode(seqno, tag, data)
+
+    def read_reverse(self, from_seqno: Optional[int] = None, tags: Optional[List[str]] = None,
+                     limit: Optional[int] = None, snapshot: Optional[Snapshot] = None,
+                     with_tags: bool = False) -> Iterable[Tuple]:
         msgtags = self._xlate_tags(tags)
-        for seq, tag, data in super().read(start_seqno, tags=msgtags):
+        for seq, tag, data in super().read_reverse(from_seqno, tags=msgtags, limit=limit, snapshot=snapshot):
             if with_tags:
-                yield seq, tag, self.deserialize(data)
+                yield seq, tag, self._decode(seq, tag, data)
             else:
-                yield seq, self.deserialize(data)
+                yield seq, self._decode(seq, tag, data)
+
+    def read_columns(self, start_seqno: int, end_seqno: Optional[int] = None, tags: Optional[List[str]] = None,
+                     fields: Optional[FieldSpec] = None) -> ColumnBatch:
+        """
+        Like MultiLog.read_columns(), but optionally also fill typed columns from the deserialized events.
+        :fields: a dict of column name: (array typecode, extractor), eg. { 'amount': ('d', lambda e: e['amount']) }
+        """
+        batch = super().read_columns(start_seqno, end_seqno, tags=self._xlate_tags(tags))
+        return fill_columns(batch, ( self._decode_payload(batch, i) for i in range(len(batch)) ), fields)
+
+    def _decode_payload(self, batch: ColumnBatch, i: int):
+        """the event in a ColumnBatch; codecs get the stored bytes as they are, the deserializer a str"""
+        seqno, tag, payload = batch.seqnos[i], batch.tag(i), batch.payload(i)
+        codec = self._seg_codec(tag, seqno // self.segment_size)
+        return self.deserialize(payload.decode('utf8')) if codec is None else codec.decode(payload)
 
 
 class AsyncSafeMultiLog(AsyncSafeLogMixin, MultiLog): pass
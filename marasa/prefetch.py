@@ -0,0 +1,93 @@
+
+import queue
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .handlepool import HandlePool
+
+# the most bytes of read-ahead segments to hold at once, by default
+MAX_BYTES = 64 * 2**20
+
+_DONE = object()
+
+
+class Prefetcher:
+    """
+    Reads whole segment files in a background thread, ahead of a consumer that's parsing earlier ones,
+    so disk reads and parsing overlap.
+
+    :segments: an iterable of lists of (key, path, limit) for the files of each segment, in the order
+        they'll be consumed; limit is how many bytes of the file to read, or None for all of it.
+    :depth: how many segments to have read ahead
+    :max_bytes: the most bytes of read-ahead data to hold; a single segment larger than this is
+        still read, but only once nothing else is being held.
+
+    Iterating over it yields a dict of key: bytes for each segment.  The budget for a segment is
+    released when the next one is asked for.
+    """
+
+    def __init__(self, segments: Iterable[List[Tuple[Any, Path, Optional[int]]]], pool: HandlePool,
+                 depth: int = 2, max_bytes: int = MAX_BYTES):
+        self._segments = segments
+        self._pool = pool
+        self._queue: queue.Queue = queue.Queue(maxsize=max(depth, 1))
+        self._max_bytes = max_bytes
+        self._held = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='marasa-prefetch', daemon=True)
+        self._thread.start()
+
+    def _put(self, item) -> bool:
+        while not self._closed:
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        try:
+            for files in self._segments:
+                sizes = [ (key, path, path.stat().st_size if limit is None else limit) for key, path, limit in files ]
+                total = sum(size for _, _, size in sizes)
+                with self._cond:
+                    while not self._closed and self._held and self._held + total > self._max_bytes:
+                        self._cond.wait()
+                    if self._closed:
+                        return
+                    self._held += total
+                data = { key: self._pool.read_at(path, 0, size) for key, path, size in sizes }
+                if not self._put((total, data)):
+                    return
+            self._put(_DONE)
+        except BaseException as e:  # pylint: disable=broad-except
+            logging.debug("prefetch failed: %r", e)
+            self._put(e)
+
+    def _release(self, size: int):
+        with self._cond:
+            self._held -= size
+            self._cond.notify()
+
+    def __iter__(self) -> Iterator[Dict[Any, bytes]]:
+        while True:
+            item = self._queue.get()
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            total, data = item
+            try:
+                yield data
+            finally:
+                self._release(total)
+
+    def close(self):
+        """stop reading ahead"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
@@ -0,0 +1,108 @@
+
+import logging
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple, Any
+
+
+class Repair:
+    """A record of a segment file being truncated back to its last valid record"""
+
+    def __init__(self, path: Path, old_size: int, new_size: int, reason: str):
+        self.path = path
+        self.old_size = old_size
+        self.new_size = new_size
+        self.reason = reason
+
+    def __repr__(self):
+        return f"<Repair {self.path.name}: {self.old_size} -> {self.new_size} bytes ({self.reason})>"
+
+
+class RecoveryReport:
+    """
+    What the open-time recovery pass did.
+    :repairs: a list of Repairs made
+    :problems: a list of strings describing inconsistencies found but not repaired
+    """
+
+    def __init__(self):
+        self.repairs: List[Repair] = []
+        self.problems: List[str] = []
+
+    def __bool__(self):
+        return bool(self.repairs or self.problems)
+
+    def __repr__(self):
+        return f"<RecoveryReport repairs={self.repairs!r} problems={self.problems!r}>"
+
+
+def _last_lines(f, size: int, blocksize: int) -> Tuple[int, bytes]:
+    """
+    Return (offset, chunk) where chunk is the end of the file starting at offset, and
+    contains at least one newline before its last line unless offset is 0.
+    """
+    offset = size
+    chunk = b''
+    while offset > 0:
+        offset = max(0, offset - blocksize)
+        f.seek(offset)
+        chunk = f.read(size - offset)
+        # need a newline strictly before the final (possibly newline-terminated) line
+        if chunk.rfind(b'\n', 0, len(chunk) - 1) >= 0:
+            break
+        blocksize *= 2
+    return offset, chunk
+
+
+def _scan_tail(f, path: Path, parse: Callable[[str], Any], blocksize: int) -> Tuple[int, str, Any]:
+    """
+    Find the last valid record in the open file :f:.
+    Returns (the size the file would have without the invalid records after it, why those records are invalid,
+    the result of parsing it or None)
+    """
+    size = f.seek(0, 2)
+    # why it would be truncated; always set if it would be
+    reason = ''
+    parsed = None
+    while size > 0:
+        offset, chunk = _last_lines(f, size, blocksize)
+        if not chunk.endswith(b'\n'):
+            # a partial write; drop everything after the last newline
+            reason = reason or "torn record"
+            size = offset + chunk.rfind(b'\n') + 1
+            continue
+        start = chunk.rfind(b'\n', 0, len(chunk) - 1) + 1
+        try:
+            parsed = parse(chunk[start:].decode('utf8'))
+            break
+        except (ValueError, UnicodeDecodeError) as e:
+            # a newline-terminated, but still unusable, record (eg. NUL-filled)
+            logging.debug("invalid tail record in %s: %r", path, e)
+            reason = reason or "invalid record"
+            size = offset + start
+    return size, reason, parsed
+
+
+def read_tail(path: Path, parse: Callable[[str], Any], blocksize: int = 4096) -> Any:
+    """
+    Like repair_tail(), but never modifies the file: return the result of parsing its last valid line, or None
+    """
+    with path.open('rb') as f:
+        return _scan_tail(f, path, parse, blocksize)[2]
+
+
+def repair_tail(path: Path, parse: Callable[[str], Any], blocksize: int = 4096) -> Tuple[Optional[Repair], Any]:
+    """
+    Check the tail of the segment file at :path:, truncating any torn or unparseable records at
+    its end.  Only the end of the file is read.
+    :parse: is called on each candidate last line; it should raise ValueError if the line is invalid
+    Returns a tuple of (the Repair made or None, the result of parsing the last valid line or None)
+    """
+    with path.open('r+b') as f:
+        old_size = f.seek(0, 2)
+        size, reason, parsed = _scan_tail(f, path, parse, blocksize)
+        if size == old_size:
+            return None, parsed
+        f.truncate(size)
+    repair = Repair(path, old_size, size, reason)
+    logging.warning("recovery: %r", repair)
+    return repair, parsed
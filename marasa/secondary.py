@@ -0,0 +1,116 @@
+
+import os
+import mmap
+import logging
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List
+
+import orjson as json
+
+
+def _encode_key(key: Any) -> str:
+    return json.dumps(key, option=json.OPT_SORT_KEYS).decode('utf8')
+
+
+class SecondaryIndex:
+    """
+    An index from the values :extractor: returns for each event to the seqnos of those events.
+    Events for which :extractor: returns None aren't indexed.
+
+    Entries for the segment currently being written are kept in memory; when the log moves
+    on to a new segment they're written to _indexes/{name}.{seg} as lines of 'seqno key',
+    sorted by key, so a lookup is a binary search per segment over the mmapped file,
+    touching only the lines it compares and the ones that match.
+    """
+
+    def __init__(self, log, name: str, extractor: Callable[[Any], Any]):
+        if not name or '/' in name or '.' in name:
+            raise ValueError(f"Invalid index name {name!r}")
+        self.log = log
+        self.name = name
+        self.extractor = extractor
+        self.dir = log.dir / '_indexes'
+        if not self.dir.exists():
+            self.dir.mkdir()
+        self._seg = log.seq // log.segment_size
+        self._current: Dict[str, List[int]] = {}
+        self.catch_up()
+
+    def _segfile(self, seg: int) -> Path:
+        return self.dir / f"{self.name}.{seg:09}"
+
+    def _persisted(self) -> List[int]:
+        return sorted(int(f.name.rsplit('.', 1)[1]) for f in self.dir.glob(f'{self.name}.*') if not f.name.endswith('.tmp'))
+
+    def catch_up(self):
+        """index any events in segments not yet persisted, and the current segment"""
+        persisted = self._persisted()
+        start = (persisted[-1] + 1 if persisted else 0) * self.log.segment_size
+        self._current = {}
+        self._seg = start // self.log.segment_size
+        if start > self.log.seq:
+            return
+        logging.debug("catching up index %r from seqno %r", self.name, start)
+        for seq, event in self.log.read(max(start, 1)):
+            self.add(seq, event)
+
+    def rebuild(self):
+        """throw away the index and rebuild it from the log"""
+        for seg in self._persisted():
+            self._segfile(seg).unlink()
+        self.catch_up()
+
+    def add(self, seqno: int, event):
+        """index the :event: stored at :seqno:"""
+        seg = seqno // self.log.segment_size
+        if seg != self._seg:
+            self._persist()
+            self._seg = seg
+        key = self.extractor(event)
+        if key is None:
+            return
+        self._current.setdefault(_encode_key(key), []).append(seqno)
+
+    def _persist(self):
+        """write out the in-memory entries as the sorted run for their segment"""
+        segfile = self._segfile(self._seg)
+        tmp = segfile.with_name(segfile.name + '.tmp')
+        with tmp.open('wb') as f:
+            for key in sorted(self._current):
+                for seqno in self._current[key]:
+                    f.write(f"{seqno} {key}\n".encode('utf8'))
+        os.replace(tmp, segfile)
+        self._current = {}
+
+    def _lookup_seg(self, seg: int, key: str) -> List[int]:
+        target = key.encode('utf8')
+        with self._segfile(seg).open('rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return []
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                # find the first line whose key is >= target; lo is always the start of a line
+                lo, hi = 0, len(m)
+                while lo < hi:
+                    start = max(m.rfind(b'\n', lo, (lo + hi) // 2) + 1, lo)
+                    end = m.find(b'\n', start)
+                    if m[start:end].split(b' ', 1)[1] < target:
+                        lo = end + 1
+                    else:
+                        hi = start
+                result = []
+                while lo < len(m):
+                    end = m.find(b'\n', lo)
+                    seqno, k = m[lo:end].split(b' ', 1)
+                    if k != target:
+                        break
+                    result.append(int(seqno))
+                    lo = end + 1
+                return result
+
+    def lookup(self, value) -> Iterator[int]:
+        """yield the seqnos of the events indexed under :value:, in order"""
+        key = _encode_key(value)
+        for seg in self._persisted():
+            if seg < self._seg:
+                yield from self._lookup_seg(seg, key)
+        yield from self._current.get(key, [])
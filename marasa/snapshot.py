@@ -0,0 +1,71 @@
+
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, Any
+
+from .constants import NOTFOUND
+from .lines import bounded_lines, reverse_lines
+
+
+class Snapshot:
+    """
+    A consistent, read-only view of a MultiLog as of a pinned seqno.
+
+    Only the segment files the log is still appending to can change, so the snapshot
+    records how much of each of those had been completely written when it was taken;
+    reads never go past those lengths, so they never see records after :seq: or
+    half-written lines, and need no lock no matter what writers do meanwhile.
+
+        with log.snapshot() as snap:
+            for seq, tag, data in snap.read(1):
+                ...
+    """
+
+    def __init__(self, log, cur: Dict[str, Tuple[int, Any]], visible: Dict[Path, int]):
+        self.log = log
+        self.cur = cur
+        self.visible = visible
+        self.seq = max((s for s, _ in cur.values()), default=0)
+        self.seg = self.seq // log.segment_size
+
+    def __enter__(self) -> 'Snapshot':
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def limit(self, segfile: Path, seg: int) -> Optional[int]:
+        """how many bytes of :segfile: (of segment :seg:) are visible in this snapshot; None means all of it"""
+        if seg > self.seg:
+            return 0
+        if seg < self.seg:
+            # earlier segments are never appended to
+            return None
+        return self.visible.get(segfile, 0)
+
+    def lines(self, segfile: Path, seg: int) -> Iterable[str]:
+        """the lines of :segfile: (of segment :seg:) that are visible in this snapshot"""
+        return bounded_lines(segfile, self.limit(segfile, seg), pool=self.log.handles)
+
+    def reverse_lines(self, segfile: Path, seg: int) -> Iterable[str]:
+        """like .lines(), but last line first"""
+        return reverse_lines(segfile, self.limit(segfile, seg), pool=self.log.handles)
+
+    def latest(self, tags: Iterable[str]):
+        """the most recent data among :tags:, or NOTFOUND"""
+        record = self.latest_record(tags)
+        return record if record is NOTFOUND else record[2]
+
+    def latest_record(self, tags: Iterable[str]):
+        """the most recent (seqno, tag, data) among :tags:, or NOTFOUND"""
+        entries = [ (self.cur[t][0], t, self.cur[t][1]) for t in tags if t in self.cur ]
+        if not entries:
+            return NOTFOUND
+        return max(entries, key=lambda e: e[0])
+
+    def get(self, tags: Optional[List[str]] = None, seqno: Optional[int] = None):
+        """like the log's .get(), but as of this snapshot"""
+        return self.log.get(tags=tags, seqno=seqno, snapshot=self)
+
+    def read(self, start_seqno: int, *a, **kw):
+        """like the log's .read(), but as of this snapshot"""
+        return self.log.read(start_seqno, *a, snapshot=self, **kw)
@@ -1,11 +1,25 @@
 
+import os
+import time
+import atexit
 import logging
+import threading
+import weakref
+from functools import partial
+from itertools import chain, islice, groupby
 from pathlib import Path
-from typing import Union, Optional, Dict, Any, List
+from typing import Union, Optional, Dict, Any, Iterator, List, Tuple, Callable
 
 import orjson as json
 
 from .constants import NOTFOUND
+from .recovery import RecoveryReport, repair_tail
+from .compactstate import CompactIndex, CompactStateDict
+from .lines import bounded_lines, reverse_lines
+from .txnlog import TxnLog
+from .handlepool import HandlePool
+from .checkpoint import Checkpointer
+from .asof import AsOf
 
 
 class StateDict(dict):
@@ -13,28 +27,93 @@ class StateDict(dict):
     seq = 0
 
 
+class CoalescedPuts:
+    """puts to one namespace, waiting to be written as a single record"""
+
+    def __init__(self, seqno: int):
+        self.first = self.last = seqno
+        self.changes: Dict[str, Any] = dict()
+        self.count = 0
+        self.started = time.monotonic()
+        # writes it out once it's max_delay old
+        self.timer: Optional[threading.Timer] = None
+
+
+def _expire(ref: 'weakref.ref[StateKeeper]', namespace: str, batch: CoalescedPuts):
+    """write out :batch: if it's still pending, max_delay after it was started"""
+    db = ref()
+    if db is None:
+        return
+    with db._lock:
+        if db._batches.get(namespace) is batch:
+            db._flush_ns(namespace)
+
+
+def _close_at_exit(ref: 'weakref.ref[StateKeeper]'):
+    db = ref()
+    if db is not None:
+        db.close()
+
+
 class StateKeeper:
     """
     StateKeeper stores data as a series of changes, written to what are essentially logfiles.
     Each logfile is segmented into at most :segment_size: lines.
     Each line consists of a sequence number followed by a space followed by the json representation of the changes
     made.
+    A segment starts with a DELTA_HEADER line; the state before its first change is checkpointed to
+    _checkpoints/{namespace}.{seg} in the background (or, with a memory_budget, to a CompactIndex in
+    _checkpoints/{namespace}.{seg}.idx and .dat).  (Older segments instead start with a full snapshot.)
     """
 
     NOTFOUND = NOTFOUND
 
-    def __init__(self, storage_dir: Union[Path, str], segment_size=10000):
+    DELTA_HEADER = '#delta\n'
+
+    def __init__(self, storage_dir: Union[Path, str], segment_size=10000, memory_budget: Optional[int] = None,
+                 commit_log: bool = False, coalesce: Optional[Dict[str, Tuple[int, float]]] = None):
         """
         :storage_dir: is the directory to store log files in
         :segment_size: is how many records to store per file; the default is 10000,
         so if average change size is 1KB, that's a 10MB file
+        :memory_budget: if set, is the most keys per namespace to keep in memory; the rest are
+        kept in a mmapped on-disk index.  The default (None) keeps every namespace in a dict.
+        :commit_log: if true, .multiput() writes each commit as one synced record in a shared
+        transaction log.  Commits are copied into the namespaces' segments by the next .put(), when a
+        commit starts a new segment, and on .close(); until then reads see them from memory.
+        :coalesce: a dict of namespace: (max_count, max_delay) for hot namespaces whose puts are merged
+        into one record of at most max_count puts.  It's written when full, by a timer once it's
+        max_delay seconds old, on .flush() or .close(), and when the interpreter exits; until then
+        reads see it from memory.
+        Each put still gets (and returns) its own seqno and is seen by .get() at once, but the record
+        is stored at the last seqno of its range, so history reads inside the range see the state from
+        before it.  So an acknowledged put is durable only once its record is written: up to max_delay
+        seconds of puts are lost if the process is killed or crashes.
         """
         self.dir = storage_dir if isinstance(storage_dir, Path) else Path(storage_dir)
         logging.debug("Making a %sDB in %s", self.__class__.__name__, str(self.dir))
         if not self.dir.exists():
             self.dir.mkdir()
         self._segment_size = segment_size
+        # this log's pool of open read handles
+        self.handles = HandlePool()
+        self.memory_budget = memory_budget
         self._state: Dict[str, StateDict] = dict()
+        self._txlog = TxnLog(self.dir / '_txn', segment_size, self.handles) if commit_log else None
+        # commits in the transaction log not yet copied into the namespaces' segments, in order.
+        # They're always newer than every record in the segments, and already in the cached states.
+        self._pending: List[Tuple[int, Dict[str, Dict[str, Any]]]] = []
+        self.checkpoints = Checkpointer(self._build_checkpoint)
+        # builds run both in the checkpoint thread and when a reader finds one missing
+        self._checkpoint_lock = threading.Lock()
+        self.coalesce = dict(coalesce or {})
+        self._batches: Dict[str, CoalescedPuts] = dict()
+        # guards the pending coalesced puts, which timers write out from other threads
+        self._lock = threading.RLock()
+        self._atexit: Optional[Callable[[], None]] = None
+        if self.coalesce:
+            self._atexit = partial(_close_at_exit, weakref.ref(self))
+            atexit.register(self._atexit)
         self._seq = self.reload()
 
     @property
@@ -47,25 +126,93 @@ class StateKeeper:
         """The maximum number of state changes per file segment"""
         return self._segment_size
 
+    def _new_state(self, namespace: str):
+        """make an empty cached state for the namespace"""
+        if self.memory_budget is None:
+            return StateDict()
+        return CompactStateDict(self.dir / '_compact', namespace, self.memory_budget)
+
     def put(self, namespace: str, kvdict):
         """
         update the set of key/value pairs in kvdict in the namespace
         return the seqno the update was applied in
         """
-        self._seq += 1
-        self._write(namespace, self._seq, kvdict)
-        return self._seq
+        with self._lock:
+            self._apply_txns()
+            if self._batches:
+                self._flush_stale()
+            self._seq += 1
+            if namespace in self.coalesce:
+                self._coalesce(namespace, self._seq, kvdict)
+            else:
+                self._write(namespace, self._seq, kvdict)
+            return self._seq
+
+    def _coalesce(self, namespace: str, seqno: int, kvdict):
+        """add a put to the namespace's pending record, writing that out if it's full"""
+        max_count, max_delay = self.coalesce[namespace]
+        batch = self._batches.get(namespace)
+        if batch is not None and batch.first // self.segment_size != seqno // self.segment_size:
+            # keep each record's range within one segment
+            self._flush_ns(namespace)
+            batch = None
+        if batch is None:
+            batch = self._batches[namespace] = CoalescedPuts(seqno)
+            batch.timer = threading.Timer(max_delay, _expire, (weakref.ref(self), namespace, batch))
+            batch.timer.daemon = True
+            batch.timer.start()
+        batch.last = seqno
+        batch.changes.update(kvdict)
+        batch.count += 1
+        self._cache(namespace, seqno, kvdict, written=False)
+        if batch.count >= max_count:
+            self._flush_ns(namespace)
+
+    def _flush_ns(self, namespace: str) -> Tuple[int, int]:
+        batch = self._batches.pop(namespace)
+        if batch.timer is not None:
+            batch.timer.cancel()
+        self._append(namespace, batch.last, batch.changes)
+        self._cache_written(namespace, batch.last, batch.changes)
+        logging.debug("wrote %d coalesced puts to %r as seqno %d", batch.count, namespace, batch.last)
+        return batch.first, batch.last
+
+    def _flush_stale(self):
+        now = time.monotonic()
+        for ns in [ ns for ns, batch in self._batches.items() if now - batch.started >= self.coalesce[ns][1] ]:
+            self._flush_ns(ns)
+
+    def flush(self) -> Dict[str, Tuple[int, int]]:
+        """
+        write out any coalesced puts
+        return a dict of namespace: (first, last) seqnos of the puts each record written holds
+        """
+        with self._lock:
+            return { ns: self._flush_ns(ns) for ns in list(self._batches) }
 
     def multiput(self, ns_kvdict):
         """
         write to multiple namespaces
         :ns_kvdict: a dictionary of namespace to kvdicts to update
         return the seqno the update was applied in
+        With a commit log, this is a single append; otherwise it's one per namespace.
         """
-        self._seq += 1
-        for ns in ns_kvdict:
-            self._write(ns, self._seq, ns_kvdict[ns])
-        return self._seq
+        with self._lock:
+            if self._txlog is not None:
+                if self._pending and self._pending[0][0] // self.segment_size != (self._seq + 1) // self.segment_size:
+                    # keep the commits readers have to overlay to at most a segment's worth
+                    self._apply_txns()
+                commit = { ns: dict(kvdict) for ns, kvdict in ns_kvdict.items() }
+                self._txlog.append(self._seq + 1, commit)
+                self._seq += 1
+                self._pending.append((self._seq, commit))
+                for ns, kvdict in commit.items():
+                    self._cache(ns, self._seq, kvdict, written=False)
+                return self._seq
+            self._seq += 1
+            for ns in ns_kvdict:
+                self._write(ns, self._seq, ns_kvdict[ns])
+            return self._seq
 
     def get(self, namespace: str, key: Optional[str]=None, seqno: Optional[int]=None):
         """
@@ -80,6 +227,52 @@ class StateKeeper:
             raise ValueError("Sequence numbers are never lower than 1")
         return self._read_history(namespace, key, seqno)
 
+    def get_many(self, namespace: str, seqnos, key: Optional[str] = None) -> List:
+        """
+        return the values from the specified namespace as of each of :seqnos:, in the same order
+        :key: only get the value of the specified key
+        The seqnos are grouped by segment, and each segment file is replayed at most once.
+        """
+        seqnos = list(seqnos)
+        if any(s < 1 for s in seqnos):
+            raise ValueError("Sequence numbers are never lower than 1")
+        pending = self._pending_ns(namespace)
+
+        def _value(state):
+            return dict(state) if key is None else state.get(key, NOTFOUND)
+
+        found: Dict[int, Any] = {}
+        for seg, group in groupby(sorted(set(seqnos)), key=lambda s: s // self.segment_size):
+            targets = iter(group)
+            target = next(targets, None)
+            segfile = self._segfile_for_seq(namespace, seg * self.segment_size)
+            state = self._seg_base(namespace, segfile, key) if segfile is not None else {}
+            lines = bounded_lines(segfile, pool=self.handles) if segfile is not None else ()
+            for seq, data in chain(self._segfile_reader(lines), pending):
+                while target is not None and seq > target:
+                    found[target] = _value(state)
+                    target = next(targets, None)
+                if target is None:
+                    break
+                self._replay(state, data, key)
+            while target is not None:
+                found[target] = _value(state)
+                target = next(targets, None)
+        return [ found[s] for s in seqnos ]
+
+    def as_of(self, seqno: Optional[int] = None) -> AsOf:
+        """
+        return a lazy, read-only mapping of namespace to its state as of :seqno: (or now, if unspecified),
+        consistent across namespaces.  Namespaces with no changes by then aren't in it.
+        """
+        if seqno is None:
+            seqno = self.seq
+        if seqno < 1:
+            raise ValueError("Sequence numbers are never lower than 1")
+        if seqno > self.seq:
+            raise ValueError(f"Sequence number {seqno} hasn't been written yet")
+        return AsOf(self, seqno)
+
     def namespaces(self):
         """
         return the set of existing namespaces
@@ -118,50 +311,206 @@ class StateKeeper:
         return biggest[1]
 
     def _write(self, namespace: str, seqno: int, kvdict):
-        """write to a single file
+        """write to a single file, and update the cache
         """
+        if namespace in self._batches:
+            # keep the namespace's records in order
+            self._flush_ns(namespace)
+        self._append(namespace, seqno, kvdict)
+        self._cache(namespace, seqno, kvdict)
+
+    def _append(self, namespace: str, seqno: int, kvdict):
+        """write a record to the namespace's segment"""
         # figure out the file to write to
-        segfile = self._segfile_for_seg(namespace, seqno // self.segment_size)
+        seg = seqno // self.segment_size
+        segfile = self._segfile_for_seg(namespace, seg)
+        dataline = str(seqno) + " " + json.dumps(kvdict).decode('utf8') + '\n'
         if not segfile.exists():
-            #  create it, and store a full snapshot in it
-            mode = 'w'
-            data: Dict = self._state.get(namespace, {}).copy()
+            # create it with only the changes; the state before them is checkpointed in the background
+            self._drop_checkpoint(namespace, seg)
+            with segfile.open('w') as f:
+                f.write(self.DELTA_HEADER + dataline)
+            if namespace in self._state:
+                self.checkpoints.submit(namespace, seg)
         else:
             # append to it, only the changes
-            mode = 'a'
-            data = dict()
-        # apply the changes to what's to be stored
-        data.update(kvdict)
-        # write it out
-        with segfile.open(mode) as f:
-            dataline = str(seqno) + " " + json.dumps(data).decode('utf8') + '\n'
-            f.write(dataline)
-        # update cache
+            with segfile.open('a') as f:
+                f.write(dataline)
+
+    def _cache(self, namespace: str, seqno: int, kvdict, written: bool = True):
+        """
+        apply changes to the namespace's cached state
+        :written: is whether they're in the namespace's segments yet; a compact state only stages them if not,
+        so they stay out of its checkpoints until _cache_written is called for them
+        """
         if namespace not in self._state:
-            self._state[namespace] = StateDict()
-        self._state[namespace].seq = seqno
-        self._state[namespace].update(kvdict)
+            self._state[namespace] = self._new_state(namespace)
+        state = self._state[namespace]
+        state.seq = seqno
+        if not isinstance(state, CompactStateDict):
+            state.update(kvdict)
+        elif written:
+            state.update(kvdict, seqno)
+        else:
+            state.stage(seqno, kvdict)
+
+    def _cache_written(self, namespace: str, seqno: int, kvdict):
+        """note that changes cached unwritten have been written to the namespace's segments as :seqno:"""
+        state = self._state.get(namespace)
+        if isinstance(state, CompactStateDict):
+            state.update(kvdict, seqno)
 
     def _read_ns(self, namespace: str):
         """Return a tuple of the last seqno and the latest state for the specified namespace"""
-        state: Dict[str, Any] = dict()
-        seqno = 0
+        state = self._new_state(namespace)
+        # a compact state may already be checkpointed partway through
+        checkpointed = state.seq
         segfile = self._segfile_for_seq(namespace, None)
         if segfile is not None:
-            with segfile.open() as f:
-                for seq, data in self._segfile_reader(f):
-                    seqno = seq
+            if checkpointed < self._segno(segfile) * self.segment_size:
+                if self.memory_budget is None:
+                    state.update(self._seg_base(namespace, segfile))
+                elif self._is_delta(segfile):
+                    # start from the segment's checkpoint, without loading it
+                    state.rebase(self._compact_base(namespace, segfile))
+            for seq, data in self._segfile_reader(bounded_lines(segfile, pool=self.handles)):
+                if seq <= checkpointed:
+                    continue
+                state.seq = seq
+                if isinstance(state, CompactStateDict):
+                    state.update(data, seq)
+                else:
                     state.update(data)
-        return seqno, state
+        return state.seq, state
+
+    def _recover_ns(self, namespace: str, report: RecoveryReport) -> int:
+        """
+        Repair the tail of the namespace's active segment, reading only the end of it.
+        Returns the last seqno left in the namespace's segments, or 0 if there's none.
+        """
+        def parse(line):
+            seqno, jdata = line.split(' ', 1)
+            return int(seqno), json.loads(jdata)
+
+        segfiles = sorted(self._segfiles(namespace), key=lambda f: int(f.name.split('.')[-1]), reverse=True)
+        for segfile in segfiles:
+            repair, parsed = repair_tail(segfile, parse)
+            if repair is not None:
+                report.repairs.append(repair)
+                self.handles.discard(segfile)
+            if parsed is not None:
+                if parsed[0] // self.segment_size != int(segfile.name.split('.')[-1]):
+                    report.problems.append(f"{segfile.name} ends with seqno {parsed[0]}, which belongs in another segment")
+                return parsed[0]
+            # nothing valid left in it; fall back to the previous segment
+            segfile.unlink()
+        return 0
+
+    def close(self):
+        """
+        write out any coalesced puts and pending commits, finish writing checkpoints, stop the checkpoint
+        thread, and close the read handles
+        """
+        with self._lock:
+            self._apply_txns()
+        self.flush()
+        if self._atexit is not None:
+            atexit.unregister(self._atexit)
+            self._atexit = None
+        self.checkpoints.close()
+        self.handles.clear()
+
+    def __enter__(self) -> 'StateKeeper':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
 
     def reload(self):
-        latest, state = 0, dict()
-        for ns in self.namespaces():
+        """
+        Rebuild the cached state from disk, first repairing any torn records at the tail of each namespace's
+        active segment.  The RecoveryReport is kept as .recovery.
+        Returns the latest seqno found.
+        """
+        self.flush()
+        report = RecoveryReport()
+        latest, states, written = 0, dict(), dict()
+        for ns in self._namespaces():
+            written[ns] = self._recover_ns(ns, report)
             seqno, state = self._read_ns(ns)
+            if seqno:
+                states[ns] = state
             latest = max(latest, seqno)
-        self._state = state
+        self._state = states
+        self._pending = []
+        if self._txlog is not None:
+            latest = max(latest, self._txlog.recover(report))
+            for seqno, commit in self._txlog.after(self._txlog.applied):
+                # leave out namespaces it was already copied into, before a crash
+                commit = { ns: kvdict for ns, kvdict in commit.items() if written.get(ns, 0) < seqno }
+                for ns, kvdict in commit.items():
+                    self._cache(ns, seqno, kvdict, written=False)
+                self._pending.append((seqno, commit))
+        self.recovery = report
         return latest
 
+    def _apply_txns(self):
+        """copy any pending commits from the transaction log into the namespaces' segments"""
+        if not self._pending:
+            return
+        pending = self._pending
+        for seqno, ns_kvdict in pending:
+            for ns, kvdict in ns_kvdict.items():
+                if ns in self._batches:
+                    # keep the namespace's records in order
+                    self._flush_ns(ns)
+                self._append(ns, seqno, kvdict)
+                self._cache_written(ns, seqno, kvdict)
+        self._txlog.applied = pending[-1][0]
+        self._pending = self._pending[len(pending):]
+
+    def _unwritten(self) -> List[Tuple[int, Dict[str, Dict[str, Any]]]]:
+        """
+        the (seqno, {namespace: changes}) not in the segments yet, in order: commits not yet copied,
+        and coalesced puts not yet written, each batch as the record it'll be written as
+        """
+        with self._lock:
+            batches = [ (batch.last, { ns: dict(batch.changes) }) for ns, batch in self._batches.items() ]
+            return sorted(batches + self._pending, key=lambda r: r[0])
+
+    def _pending_ns(self, namespace: str) -> List[Tuple[int, Dict[str, Any]]]:
+        """the (seqno, changes) to the namespace not in its segments yet, in order"""
+        return [ (seqno, changes[namespace]) for seqno, changes in self._unwritten() if namespace in changes ]
+
+    def _seg_records(self, namespace: str, seg: int) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """the namespace's records in segment :seg:, followed by its changes not written there yet"""
+        pending = self._pending_ns(namespace)
+        segfile = self._segfile_for_seg(namespace, seg)
+        last = 0
+        if segfile.exists():
+            for seq, data in self._segfile_reader(bounded_lines(segfile, pool=self.handles)):
+                last = seq
+                yield seq, data
+        for seq, data in pending:
+            # skipping any written while this was being read
+            if seq > last and seq // self.segment_size == seg:
+                yield seq, data
+
+    def _state_before(self, namespace: str, seg: int, key: Optional[str] = None) -> Dict[str, Any]:
+        """the namespace's state (or only :key: in it) just before segment :seg:, counting pending commits"""
+        start = seg * self.segment_size
+        segfile = self._segfile_for_seq(namespace, start)
+        state = self._seg_base(namespace, segfile, key) if segfile is not None else {}
+        if segfile is not None and self._segno(segfile) < seg:
+            for _, data in self._segfile_reader(bounded_lines(segfile, pool=self.handles)):
+                self._replay(state, data, key)
+        for seq, data in self._pending_ns(namespace):
+            if seq >= start:
+                break
+            self._replay(state, data, key)
+        return state
+
     def _read_cur(self, namespace, key=None):
         if not self._state:
             # repop the cache by reading all namespaces
@@ -174,9 +523,158 @@ class StateKeeper:
             return value
         return value.get(key, NOTFOUND)
 
+    @staticmethod
+    def _segno(segfile: Path) -> int:
+        return int(segfile.name.split('.')[-1])
+
+    def _checkpoint_file(self, namespace: str, seg: int) -> Path:
+        return self.dir / '_checkpoints' / f"{namespace}.{seg:09}"
+
+    def _compact_checkpoint_files(self, namespace: str, seg: int) -> Tuple[Path, Path]:
+        ckpt = self._checkpoint_file(namespace, seg)
+        return ckpt.with_name(ckpt.name + '.idx'), ckpt.with_name(ckpt.name + '.dat')
+
+    def _drop_checkpoint(self, namespace: str, seg: int):
+        """remove a stale checkpoint, eg. for a segment that was emptied by recovery"""
+        for f in (self._checkpoint_file(namespace, seg), *self._compact_checkpoint_files(namespace, seg)):
+            try:
+                f.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _is_delta(self, segfile: Path) -> bool:
+        """whether the segment starts with changes rather than a full snapshot"""
+        return next(bounded_lines(segfile, pool=self.handles, blocksize=64), None) == self.DELTA_HEADER
+
+    def _seg_base(self, namespace: str, segfile: Path, key: Optional[str] = None) -> Dict[str, Any]:
+        """
+        The namespace's state just before the first record in :segfile:, or only :key: in it, if specified.
+        That's nothing for a segment that starts with a full snapshot; otherwise it's the segment's
+        checkpoint, or if that isn't written (yet, or before a crash), it's rebuilt from earlier segments.
+        With a memory_budget, the checkpoint is a CompactIndex, and only :key: is read from it.
+        """
+        if self.memory_budget is not None:
+            if not self._segno(segfile) or not self._is_delta(segfile):
+                return {}
+            index = self._compact_base(namespace, segfile)
+            try:
+                if key is None:
+                    return dict(index.items())
+                value = index.get(key)
+                return {} if value is NOTFOUND else { key: value }
+            finally:
+                index.close()
+        state = self._seg_state(namespace, segfile)
+        if key is None:
+            return state
+        return { key: state[key] } if key in state else {}
+
+    @staticmethod
+    def _replay(state: Dict[str, Any], data: Dict[str, Any], key: Optional[str] = None):
+        """apply a record to :state:, keeping only :key: if specified"""
+        if key is None:
+            state.update(data)
+        elif key in data:
+            state[key] = data[key]
+
+    def _seg_state(self, namespace: str, segfile: Path) -> Dict[str, Any]:
+        """the full state before :segfile:, from the json checkpoint or earlier segments"""
+        state: Dict[str, Any] = {}
+        replay = []
+        while self._is_delta(segfile):
+            seg = self._segno(segfile)
+            try:
+                state = json.loads(self._checkpoint_file(namespace, seg).read_bytes())
+                break
+            except FileNotFoundError:
+                pass
+            prev = self._segfile_for_seq(namespace, seg * self.segment_size - 1) if seg else None
+            if prev is None:
+                break
+            replay.append(prev)
+            segfile = prev
+        for prev in reversed(replay):
+            for _, data in self._segfile_reader(bounded_lines(prev, pool=self.handles)):
+                state.update(data)
+        return state
+
+    def _compact_base(self, namespace: str, segfile: Path) -> CompactIndex:
+        """the CompactIndex checkpoint of the state before :segfile:, built first if it's missing"""
+        seg = self._segno(segfile)
+        idxfile, datfile = self._compact_checkpoint_files(namespace, seg)
+        if not idxfile.exists():
+            self._build_checkpoint(namespace, seg)
+        return CompactIndex(idxfile, datfile)
+
+    def _build_checkpoint(self, namespace: str, seg: int):
+        """write the checkpoint for the start of segment :seg: of the namespace"""
+        with self._checkpoint_lock:
+            segfile = self._segfile_for_seg(namespace, seg)
+            if not segfile.exists():
+                return
+            if self.memory_budget is not None:
+                self._build_compact_checkpoint(namespace, seg, segfile, self.memory_budget)
+                return
+            ckpt = self._checkpoint_file(namespace, seg)
+            if ckpt.exists():
+                return
+            state = self._seg_state(namespace, segfile)
+            if not ckpt.parent.exists():
+                ckpt.parent.mkdir(exist_ok=True)
+            tmp = ckpt.with_name(ckpt.name + '.tmp')
+            tmp.write_bytes(json.dumps(state))
+            os.replace(tmp, ckpt)
+        logging.debug("checkpointed %r at segment %d", namespace, seg)
+
+    def _build_compact_checkpoint(self, namespace: str, seg: int, segfile: Path, budget: int):
+        """
+        Write segment :seg:'s checkpoint as a CompactIndex, keeping at most :budget: keys in memory:
+        the segments since the nearest earlier compact checkpoint are replayed into a scratch CompactStateDict
+        on top of it, which spills to disk as it goes.
+        """
+        idxfile, datfile = self._compact_checkpoint_files(namespace, seg)
+        if idxfile.exists():
+            return
+        base = None
+        replay = []
+        while self._is_delta(segfile):
+            prevseg = self._segno(segfile)
+            if prevseg != seg and self._compact_checkpoint_files(namespace, prevseg)[0].exists():
+                base = CompactIndex(*self._compact_checkpoint_files(namespace, prevseg))
+                break
+            prev = self._segfile_for_seq(namespace, prevseg * self.segment_size - 1) if prevseg else None
+            if prev is None:
+                break
+            replay.append(prev)
+            segfile = prev
+        scratch_name = f"{namespace}.{seg:09}.build"
+        scratch_files = [ idxfile.with_name(scratch_name + ext) for ext in ('.idx', '.dat') ]
+        for f in scratch_files:
+            # left over from a crash, and not to be mistaken for progress
+            try:
+                f.unlink()
+            except FileNotFoundError:
+                pass
+        scratch = CompactStateDict(idxfile.parent, scratch_name, budget, base)
+        try:
+            for prev in reversed(replay):
+                for _, data in self._segfile_reader(bounded_lines(prev, pool=self.handles)):
+                    scratch.update(data)
+            CompactIndex.write(idxfile, datfile, seg * self.segment_size - 1, scratch.items()).close()
+        finally:
+            scratch.index.close()
+            for f in scratch_files:
+                try:
+                    f.unlink()
+                except FileNotFoundError:
+                    pass
+
     @staticmethod
     def _segfile_reader(fh):
         for line in fh:
+            if line.startswith('#'):
+                # a segment header
+                continue
             seqno, jdata = line.split(' ', 1)
             logging.debug("segfile returning %r %r", seqno, jdata)
             yield int(seqno), json.loads(jdata)
@@ -186,14 +684,18 @@ class StateKeeper:
         if seqno == self.seq:
             return self._read_cur(namespace, key)
         logging.debug("looking in history")
-        state = {}
         # read from a point in history
-        with self._segfile_for_seq(namespace, seqno).open() as f:
-            for seq, data in self._segfile_reader(f):
-                if seq <= seqno:
-                    state.update(data)
-                else:
-                    break
+        segfile = self._segfile_for_seq(namespace, seqno)
+        pending = self._pending_ns(namespace)
+        if segfile is None and not pending:
+            return {} if key is None else NOTFOUND
+        state = self._seg_base(namespace, segfile, key) if segfile is not None else {}
+        lines = bounded_lines(segfile, pool=self.handles) if segfile is not None else ()
+        for seq, data in chain(self._segfile_reader(lines), pending):
+            if seq <= seqno:
+                self._replay(state, data, key)
+            else:
+                break
         if key is None:
             return state
         logging.debug("read historical state %r", state)
@@ -205,27 +707,34 @@ class StateKeeper:
         of either the specified key or the whole namespace if key is None
         If the specified key doesn't exist at start_seqno, NOTFOUND will be returned
         """
-        # get full initial state to send
+        # get full initial state to send, from the latest segment at or before start_seqno's,
+        # counting those only in commits not yet copied into the segments
+        startseg = start_seqno // self.segment_size
         segfile = self._segfile_for_seq(namespace, start_seqno)
-        if segfile is None:
+        segs = [ seq // self.segment_size for seq, _ in self._pending_ns(namespace) if seq // self.segment_size <= startseg ]
+        if segfile is not None:
+            segs.append(self._segno(segfile))
+        if not segs:
             yield start_seqno, NOTFOUND
         else:
-            state = {} if key is None else { key: NOTFOUND }
+            firstseg = max(segs)
+            base = self._state_before(namespace, firstseg, key)
+            state = base if key is None else { key: base.get(key, NOTFOUND) }
             sentfirst = False
-            with segfile.open() as f:
-                for seq, data in self._segfile_reader(f):
-                    state.update(data)
-                    if key is None:
+            for seq, data in self._seg_records(namespace, firstseg):
+                state.update(data)
+                if key is None:
+                    if seq >= start_seqno:
+                        yield seq, state
+                        sentfirst = True
+                else:
+                    if not sentfirst:
                         if seq >= start_seqno:
-                            yield seq, state
-                    else:
-                        if not sentfirst:
-                            if seq >= start_seqno:
-                                yield start_seqno, state[key]
-                                sentfirst = True
-                            state[key] = data.get(key, NOTFOUND)
-                        if key in data:
-                            yield seq, data[key]
+                            yield start_seqno, state[key]
+                            sentfirst = True
+                        state[key] = data.get(key, NOTFOUND)
+                    if key in data:
+                        yield seq, data[key]
             if not sentfirst:
                 yield start_seqno, state if key is None else state[key]
 
@@ -234,15 +743,48 @@ class StateKeeper:
         lastseg = lambda : self.seq // self.segment_size
         while curseg < lastseg():
             curseg += 1
-            segfile = self._segfile_for_seg(namespace, curseg)
-            if not segfile.exists(): continue
-            with segfile.open() as f:
-                for seq, data in self._segfile_reader(f):
+            for seq, data in self._seg_records(namespace, curseg):
+                if key is None:
+                    yield seq, data
+                elif key in data:
+                    yield seq, data[key]
+
+    def read_ns_reverse(self, namespace: str, from_seqno: Optional[int] = None, key=None, limit: Optional[int] = None):
+        """
+        Return a generator of the changes to the namespace (or to :key: in it, if specified), newest first,
+        starting at :from_seqno: (or the latest if it's None) and going back at most :limit: changes.
+        If :from_seqno: is negative, it's counted back from the (current) end, as with MultiLog.read_reverse().
+        Segments written before delta headers start with the full state at that seqno instead.
+        Segments are read from their ends, so only about :limit: records are ever parsed.
+        """
+        if from_seqno is None or from_seqno > self.seq:
+            from_seqno = self.seq
+        elif from_seqno < 0:
+            from_seqno = max(from_seqno + self.seq, 0)
+
+        def _changes():
+            # commits not yet copied into the segments are newer than anything in them
+            upto = from_seqno
+            for seq, data in reversed(self._pending_ns(namespace)):
+                if seq > from_seqno:
+                    continue
+                upto = seq - 1
+                if key is None:
+                    yield seq, data
+                elif key in data:
+                    yield seq, data[key]
+            for seg in range(upto // self.segment_size, -1, -1):
+                segfile = self._segfile_for_seg(namespace, seg)
+                if not segfile.exists(): continue
+                for seq, data in self._segfile_reader(reverse_lines(segfile, pool=self.handles)):
+                    if seq > upto:
+                        continue
                     if key is None:
                         yield seq, data
                     elif key in data:
                         yield seq, data[key]
 
+        return islice(_changes(), limit)
 
     def read(self, start_seqno: int, namespaces=None, key=None):
         """
@@ -250,12 +792,6 @@ class StateKeeper:
         (or all if unspecifed), in order
         Note that returned state is nested in a dict of namespaces.
         """
-        def _existing_segfiles(namespaces, segno):
-            for ns in namespaces:
-                segfile = self._segfile_for_seg(ns, segno)
-                if segfile.exists():
-                    yield ns, segfile
-
         def _matches_seq(d, s):
             return any(d[k][0] == s for k in d)
 
@@ -272,59 +808,79 @@ class StateKeeper:
                     r[ns] = d[ns]
             return r
 
-        nspaces = self._namespaces() if namespaces is None else namespaces
+        nspaces = self._namespaces() | { ns for _, changes in self._unwritten() for ns in changes } if namespaces is None else namespaces
         curseg = ( start_seqno // self.segment_size )
-        state: Dict[str, Dict[str, Any]] = { ns: {} for ns in nspaces }
+        # the state of each namespace before the first segment read; only needed to report the key
+        start = curseg * self.segment_size - 1
+
+        def _initial(ns):
+            if key is None or start <= 0:
+                return {}
+            value = self._read_history(ns, key, start)
+            return {} if value is NOTFOUND else { key: value }
+
+        state: Dict[str, Dict[str, Any]] = { ns: _initial(ns) for ns in nspaces }
         sentfirst = False
-        while curseg < self.seq // self.segment_size:
-            logging.debug("Traversing segment %d", curseg)
-            cursors = { ns: self._segfile_reader(f.open()) for ns, f in  _existing_segfiles(nspaces, curseg) }
-            current = { ns: next(cursors[ns]) for ns in cursors }
-            while cursors:
-                delta = dict()
-                # get the current item with the lowest seqno
-                ns, (minseq, data) = min(current.items(), key=lambda i: i[1][0])
-                # coalesce any cross-namespace updates
-                ## as long as there's a current item with tha seq
-                while any(current[k][0] == minseq for k in current):
-                    ns, (seq, data) = min(current.items(), key=lambda i: i[1][0])
-                    ## update the current item for that ns
-                    current[ns] = next(cursors[ns], None)
-                    ## if that was the last item from that ns, remove its current and cursor
-                    if current[ns] is None:
-                        del current[ns]
-                        del cursors[ns]
-                    delta[ns] = data
-                logging.debug("Delta is %r", delta)
-                # figure out what to return
-                if key is None:
-                    ## no key, return the full change
+
+        def _deltas():
+            curseg = ( start_seqno // self.segment_size )
+            while curseg <= self.seq // self.segment_size:
+                logging.debug("Traversing segment %d", curseg)
+                # each namespace's records, then its changes not written there yet
+                cursors = { ns: self._seg_records(ns, curseg) for ns in nspaces }
+                current = { ns: next(cursors[ns], None) for ns in cursors }
+                for ns in [ ns for ns in current if current[ns] is None ]:
+                    del current[ns]
+                    del cursors[ns]
+                while cursors:
+                    delta = dict()
+                    # get the current item with the lowest seqno
+                    ns, (minseq, data) = min(current.items(), key=lambda i: i[1][0])
+                    # coalesce any cross-namespace updates
+                    ## as long as there's a current item with tha seq
+                    while any(current[k][0] == minseq for k in current):
+                        ns, (seq, data) = min(current.items(), key=lambda i: i[1][0])
+                        ## update the current item for that ns
+                        current[ns] = next(cursors[ns], None)
+                        ## if that was the last item from that ns, remove its current and cursor
+                        if current[ns] is None:
+                            del current[ns]
+                            del cursors[ns]
+                        delta[ns] = data
                     yield seq, delta
+                curseg += 1
+
+        for seq, delta in _deltas():
+            logging.debug("Delta is %r", delta)
+            # figure out what to return
+            if key is None:
+                ## no key, return the full change
+                yield seq, delta
+            else:
+                ## apply the delta
+                for ns in delta:
+                    state.setdefault(ns, {}).update(delta[ns])
+                logging.debug("state updated to %r", state)
+                if not sentfirst:
+                    if seq >= start_seqno:
+                        # we're due, but havent sent the first update 
+                        # (which should show key state then even if NOTFOUND)
+                        # so do so, and mark it done
+                        yield start_seqno, { ns: { key: state[ns].get(key, NOTFOUND) } for ns in nspaces }
+                        sentfirst = True
+                    # trim kept state to what we care about
+                    state = { ns: { key: state[ns].get(key, NOTFOUND) } for ns in nspaces }
                 else:
-                    ## apply the delta
-                    state.update(delta)
-                    logging.debug("state updated to %r", state)
-                    if not sentfirst:
-                        if seq >= start_seqno:
-                            # we're due, but havent sent the first update 
-                            # (which should show key state then even if NOTFOUND)
-                            # so do so, and mark it done
-                            yield start_seqno, { ns: { key: state[ns].get(key, NOTFOUND) } for ns in nspaces }
-                            sentfirst = True
-                        # trim kept state to what we care about
-                        state = { ns: { key: state[ns].get(key, NOTFOUND) } for ns in nspaces }
-                    else:
-                        # non-initial update, only show changes to the key we're interested in
-                        # trim the delta to only updates we care about
-                        for ns in delta:
-                            if key not in delta[ns]:
-                                del delta[ns]
-                            else:
-                                delta[ns] = { key: delta[ns][key] }
-                        # if something left after trimming, yield it
-                        if delta:
-                            yield seq, delta
-            curseg += 1
+                    # non-initial update, only show changes to the key we're interested in
+                    # trim the delta to only updates we care about
+                    for ns in list(delta):
+                        if key not in delta[ns]:
+                            del delta[ns]
+                        else:
+                            delta[ns] = { key: delta[ns][key] }
+                    # if something left after trimming, yield it
+                    if delta:
+                        yield seq, delta
 
 Kehinde = StateKeeper
 
@@ -356,5 +912,5 @@ class MultiWrite:
         return self
 
     def execute(self):
-        self.db.multiwrite(self.ops)
+        return self.db.multiput(self.ops)
 
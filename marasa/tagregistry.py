@@ -0,0 +1,55 @@
+
+import re
+import logging
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional
+
+
+class TagRegistry:
+    """
+    The set of tags a log has, and which of them each regex matches.
+
+    :scan: returns every tag on disk; it's only called when the registry is first used or .reset().
+    After that, .add() is how tags get in, so the directory isn't globbed again, and pattern
+    results are kept until a new tag shows up.
+    """
+
+    # how many patterns' results to keep
+    MAX_PATTERNS = 256
+
+    def __init__(self, scan: Callable[[], Iterable[str]]):
+        self._scan = scan
+        self._tags: Optional[FrozenSet[str]] = None
+        self._matches: Dict[str, List[str]] = {}
+
+    def tags(self) -> FrozenSet[str]:
+        """all the tags"""
+        tags = self._tags
+        if tags is None:
+            tags = self._tags = frozenset(self._scan())
+        return tags
+
+    def add(self, tag: str):
+        """note that :tag: has been written"""
+        tags = self.tags()
+        if tag not in tags:
+            logging.debug("new tag %r", tag)
+            self._tags = tags | {tag}
+            self._matches = {}
+
+    def reset(self):
+        """forget everything; the next use scans again"""
+        self._tags = None
+        self._matches = {}
+
+    def matching(self, pattern: str) -> List[str]:
+        """the tags that :pattern: (a regex) fully matches, sorted"""
+        tags = self.tags()
+        matches = self._matches
+        found = matches.get(pattern)
+        if found is None:
+            compiled = re.compile(pattern)
+            found = sorted(tag for tag in tags if compiled.fullmatch(tag))
+            if len(matches) >= self.MAX_PATTERNS:
+                matches.clear()
+            matches[pattern] = found
+        return found
@@ -0,0 +1,82 @@
+
+import os
+from pathlib import Path
+from typing import Any, Dict, Iterator, Tuple
+
+import orjson as json
+
+from .handlepool import HandlePool, DEFAULT_POOL
+from .lines import bounded_lines
+from .recovery import RecoveryReport, repair_tail
+
+
+class TxnLog:
+    """
+    A log of multi-namespace commits, each a single line of '{seqno} {json of namespace: changes}',
+    appended and synced with one write so a commit is either wholly on disk or not at all.
+    It's segmented like the logs it feeds.  The 'applied' file records the last seqno whose
+    changes have been copied into the per-namespace segments.
+    """
+
+    def __init__(self, directory: Path, segment_size: int, pool: HandlePool = DEFAULT_POOL):
+        self.dir = directory
+        if not self.dir.exists():
+            self.dir.mkdir()
+        self.segment_size = segment_size
+        self.pool = pool
+        self._applied_file = self.dir / 'applied'
+
+    def _segfile(self, seg: int) -> Path:
+        return self.dir / f"txn.{seg:09}"
+
+    def _segs(self):
+        return sorted(int(f.name.split('.')[-1]) for f in self.dir.glob('txn.*'))
+
+    def append(self, seqno: int, ns_kvdict: Dict[str, Dict[str, Any]]):
+        """durably write a commit"""
+        line = str(seqno).encode('utf8') + b' ' + json.dumps(ns_kvdict) + b'\n'
+        with self._segfile(seqno // self.segment_size).open('ab') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def recover(self, report: RecoveryReport) -> int:
+        """drop any torn commit at the end of the log; return the last committed seqno (0 if none)"""
+        def parse(line):
+            seqno, jdata = line.split(' ', 1)
+            json.loads(jdata)
+            return int(seqno)
+
+        for seg in reversed(self._segs()):
+            segfile = self._segfile(seg)
+            repair, seqno = repair_tail(segfile, parse)
+            if repair is not None:
+                report.repairs.append(repair)
+                self.pool.discard(segfile)
+            if seqno is not None:
+                return seqno
+        return 0
+
+    @property
+    def applied(self) -> int:
+        """the last seqno known to be copied into the per-namespace segments"""
+        try:
+            return int(self._applied_file.read_text() or 0)
+        except FileNotFoundError:
+            return 0
+
+    @applied.setter
+    def applied(self, seqno: int):
+        tmp = self._applied_file.with_name('applied.tmp')
+        tmp.write_text(str(seqno))
+        os.replace(tmp, self._applied_file)
+
+    def after(self, seqno: int) -> Iterator[Tuple[int, Dict[str, Dict[str, Any]]]]:
+        """yield the (seqno, commit) records after :seqno:, in order"""
+        for seg in self._segs():
+            if (seg + 1) * self.segment_size <= seqno:
+                continue
+            for line in bounded_lines(self._segfile(seg), pool=self.pool):
+                seq, jdata = line.split(' ', 1)
+                if int(seq) > seqno:
+                    yield int(seq), json.loads(jdata)
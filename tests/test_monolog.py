@@ -0,0 +1,24 @@
+from marasa import NOTFOUND
+
+
+def test_put_get_read(monolog):
+
+    for n in range(1, 12):
+        assert monolog.put(f"e{n}") == n
+
+    assert monolog.get() == "e11"
+    assert monolog.get(seqno=4) == "e4"
+    assert list(monolog.read(10)) == [(10, "e10"), (11, "e11")]
+    assert [ n for n, _ in monolog.read(3) ] == list(range(3, 12))
+    assert [ n for n, _ in monolog.read_reverse() ] == list(range(11, 0, -1))
+    assert list(monolog.read_reverse(7, limit=2)) == [(7, "e7"), (6, "e6")]
+
+
+def test_get_many(monolog):
+
+    for n in range(1, 12):
+        monolog.put(f"e{n}")
+
+    assert monolog.get_many([8, 3, 20]) == ["e8", "e3", NOTFOUND]
+    # the same events as one at a time
+    assert monolog.get_many(range(1, 12)) == [ monolog.get(seqno=n) for n in range(1, 12) ]
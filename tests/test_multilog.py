@@ -1,3 +1,11 @@
+import json
+import shutil
+
+import pytest
+
+from marasa import MultiLog, SerializingMultiLog
+from marasa.codec import Codec, JSON, StructCodec
+from marasa.handlepool import HandlePool
 
 from collections import namedtuple
 
@@ -70,3 +78,357 @@ def test_multi_put_get_ser(ser_multilog):
          assert n % 3 == 0
 
 
+
+
+def test_read_columns(multilog):
+
+    for n in range(1, 12):
+        datum = f"a{n}" if n % 3 == 0 else f"b{n}"
+        multilog.put(datum, datum[0])
+
+    batch = multilog.read_columns(2)
+    assert list(batch.seqnos) == list(range(2, 12))
+    for i, n in enumerate(batch.seqnos):
+        tag = 'a' if n % 3 == 0 else 'b'
+        assert batch.tag(i) == tag
+        assert batch.payload(i) == f"{tag}{n}".encode('utf8')
+
+    batch = multilog.read_columns(1, tags=['a'])
+    assert list(batch.seqnos) == [3, 6, 9]
+    assert batch.tags == ['a']
+
+
+def test_read_columns_ser(ser_multilog):
+
+    for n in range(1, 12):
+        ser_multilog.put(MyTestClassA(data=n, half=n/2))
+
+    batch = ser_multilog.read_columns(1, fields={'data': ('q', lambda e: e['data']),
+                                                 'half': ('d', lambda e: e['half'])})
+    assert list(batch.columns['data']) == list(range(1, 12))
+    assert list(batch.columns['half']) == [n/2 for n in range(1, 12)]
+
+
+def test_torn_tail_recovery(tmpdir):
+
+    log = MultiLog(str(tmpdir), segment_size=5)
+    for n in range(1, 8):
+        log.put(f"a{n}", 'a' if n % 2 else 'b')
+
+    # simulate a crash mid-write of seqno 8
+    with log._segfile_for_seg('b', 1).open('a') as f:
+        f.write("8 b a")
+
+    log = MultiLog(str(tmpdir), segment_size=5)
+    assert len(log.recovery.repairs) == 1
+    assert not log.recovery.problems
+    assert log.seq == 7
+    assert log.get() == "a7"
+    assert [ n for n, _, _ in log.read(1) ] == list(range(1, 8))
+    assert log.put("a8", 'b') == 8
+    assert log.get(seqno=8) == "a8\n"
+
+
+def test_snapshot(multilog):
+
+    for n in range(1, 7):
+        multilog.put(f"a{n}", 'a' if n % 2 else 'b')
+
+    with multilog.snapshot() as snap:
+        events = snap.read(1)
+        assert next(events)[0] == 1
+        # writes during iteration, including into a new segment, aren't seen
+        for n in range(7, 12):
+            multilog.put(f"a{n}", 'a' if n % 2 else 'b')
+        assert [ n for n, _, _ in events ] == list(range(2, 7))
+        assert snap.seq == 6
+        assert snap.get() == "a6"
+        assert snap.get(seqno=8) == multilog.NOTFOUND
+
+    assert [ n for n, _, _ in multilog.read(1) ] == list(range(1, 12))
+
+
+def test_snapshot_during_roll(multilog, monkeypatch):
+    for n in range(1, 5):
+        multilog.put(f"a{n}", 'a')
+
+    # take a snapshot in the middle of starting the next segment
+    snaps = []
+    segment_header = multilog._segment_header
+    def _segment_header(tag):
+        snaps.append(multilog.snapshot())
+        return segment_header(tag)
+    monkeypatch.setattr(multilog, '_segment_header', _segment_header)
+    multilog.put("b5", 'b')
+
+    snap = snaps[0]
+    assert snap.seq == 4
+    assert [ n for n, _, _ in multilog.read(1, snapshot=snap) ] == [1, 2, 3, 4]
+    assert multilog.get(seqno=4, snapshot=snap) == "a4\n"
+
+
+def test_cursor(multilog):
+
+    for n in range(1, 12):
+        datum = f"a{n}" if n % 3 == 0 else f"b{n}"
+        multilog.put(datum, datum[0])
+
+    cur = multilog.cursor('billing', tags=['a'])
+    assert [ n for n, _, _ in cur.poll(2) ] == [3, 6]
+    cur.commit()
+    assert [ n for n, _, _ in cur.poll(2) ] == [9]
+    assert cur.poll(2) == []
+
+    other = multilog.cursor('audit')
+    assert len(other.poll(4)) == 4
+    other.commit()
+    assert multilog.min_committed_seqno() == 4
+    assert set(multilog.cursors()) == {'billing', 'audit'}
+
+    # a reopened cursor resumes from its last commit
+    cur = multilog.cursor('billing', tags=['a'])
+    assert [ n for n, _, _ in cur.poll(5) ] == [9]
+
+    # reading a torn commit leaves it alone; the next commit repairs it, and counts the lines already there
+    with cur.path.open('ab') as f:
+        f.write(b'1')
+    assert multilog.min_committed_seqno() == 4
+    cur = multilog.cursor('billing', tags=['a'])
+    assert cur.committed == 6 and cur._lines == 1
+    assert cur.path.read_bytes() == b'6\n1'
+    cur.commit(9)
+    assert cur.path.read_bytes() == b'6\n9\n'
+    assert cur._lines == 2
+
+
+def test_v1_segments(multilog):
+
+    # segments in the original format, with the tag on every line
+    with multilog._segfile_for_seg('a', 0).open('w') as f:
+        f.write("1 a a1\n3 a a3\n")
+    with multilog._segfile_for_seg('b', 0).open('w') as f:
+        f.write("2 b b2\n")
+    multilog.reload()
+    assert multilog.seq == 3
+
+    multilog.put("a4", 'a')
+    multilog.put("a5", 'a')
+    assert multilog._segfile_for_seg('a', 0).read_text() == "1 a a1\n3 a a3\n4 a a4\n"
+    assert multilog._segfile_for_seg('a', 1).read_text() == "#v2 a\n5 a5\n"
+
+    events = list(multilog.read(1))
+    assert [ (n, tag) for n, tag, _ in events ] == [(1, 'a'), (2, 'b'), (3, 'a'), (4, 'a'), (5, 'a')]
+    assert events[0][1] is events[4][1]
+    assert multilog.get(seqno=2) == "b2\n"
+
+
+def test_read_reverse(multilog):
+
+    for n in range(1, 12):
+        datum = f"a{n}" if n % 3 == 0 else f"b{n}"
+        multilog.put(datum, datum[0])
+
+    assert [ n for n, _, _ in multilog.read_reverse() ] == list(range(11, 0, -1))
+    assert [ n for n, _, _ in multilog.read_reverse(10, limit=3) ] == [10, 9, 8]
+    assert [ n for n, _, _ in multilog.read_reverse(tags=['a'], limit=2) ] == [9, 6]
+    assert [ d for _, _, d in multilog.read_reverse(-3, tags=['b'], limit=2) ] == ["b8\n", "b7\n"]
+
+
+def test_handle_pool(multilog):
+
+    multilog.handles = HandlePool(maxsize=3)
+    for n in range(1, 50):
+        multilog.put(f"e{n}", f"t{n % 20}")
+
+    assert [ n for n, _, _ in multilog.read(1) ] == list(range(1, 50))
+    assert len(multilog.handles) <= 3
+    assert multilog.get(seqno=7) == "e7\n"
+    multilog.handles.clear()
+    assert len(multilog.handles) == 0
+
+
+def test_handle_pool_replaced_files(tmpdir):
+    path = str(tmpdir / 'db')
+    db = MultiLog(path, segment_size=5)
+    for n in range(1, 4):
+        db.put(f"old{n}", 't')
+    assert db.get(seqno=2) == "old2\n"
+    shutil.rmtree(path)
+
+    pool = db.handles
+    db = MultiLog(path, segment_size=5)
+    # even a pool with handles open on the removed files
+    db.handles = pool
+    for n in range(1, 4):
+        db.put(f"new{n}", 't')
+    assert [ d for _, _, d in db.read(1) ] == ["new1\n", "new2\n", "new3\n"]
+    assert db.get(seqno=2) == "new2\n"
+
+
+def test_get_many(multilog):
+
+    for n in range(1, 12):
+        datum = f"a{n}" if n % 3 == 0 else f"b{n}"
+        multilog.put(datum, datum[0])
+
+    assert multilog.get_many([9, 2, 11, 40, 9]) == ["a9\n", "b2\n", "b11\n", multilog.NOTFOUND, "a9\n"]
+    assert multilog.get_many([3, 4], tags=['a']) == ["a3\n", multilog.NOTFOUND]
+
+
+def test_get_many_ser(ser_multilog):
+
+    for n in range(1, 12):
+        ser_multilog.put(MyTestClassA(data=n))
+
+    assert [ e['data'] for e in ser_multilog.get_many([7, 1, 10]) ] == [7, 1, 10]
+
+
+def test_secondary_index(tmpdir):
+
+    log = SerializingMultiLog(str(tmpdir), json.dumps, json.loads, segment_size=5,
+                              indexes={'customer': lambda e: e.get('customer')})
+    for n in range(1, 15):
+        log.put({'customer': n % 3, 'n': n} if n != 7 else {'n': n}, tag='Order')
+
+    assert list(log.lookup('customer', 1)) == [1, 4, 10, 13]
+    assert [ e['n'] for _, e in log.lookup('customer', 2, with_events=True) ] == [2, 5, 8, 11, 14]
+    assert list(log.lookup('customer', 42)) == []
+
+    # the index survives reopening, and an index added later is built from the log
+    log = SerializingMultiLog(str(tmpdir), json.dumps, json.loads, segment_size=5,
+                              indexes={'customer': lambda e: e.get('customer')})
+    log.add_index('parity', lambda e: e['n'] % 2)
+    log.put({'customer': 1, 'n': 15}, tag='Order')
+    assert list(log.lookup('customer', 1)) == [1, 4, 10, 13, 15]
+    assert list(log.lookup('parity', 1)) == list(range(1, 16, 2))
+    log.indexes['customer'].rebuild()
+    assert list(log.lookup('customer', 0)) == [3, 6, 9, 12]
+
+
+def test_secondary_index_search(tmpdir):
+
+    log = SerializingMultiLog(str(tmpdir), json.dumps, json.loads, segment_size=50,
+                              indexes={'v': lambda e: e['v']})
+    values = [ (n * 37) % 23 for n in range(1, 120) ]
+    for v in values:
+        log.put({'v': v if v % 5 else f"s{v}"})
+
+    # sorted runs are searched in place; every key, and keys between, before and after them
+    for v in range(-1, 25):
+        key = v if v % 5 else f"s{v}"
+        assert list(log.lookup('v', key)) == [ s for s, x in enumerate(values, 1) if x == v ]
+    assert list(log.lookup('v', 'zzz')) == []
+
+
+def test_prefetch(multilog):
+
+    for n in range(1, 40):
+        datum = f"a{n}" if n % 3 == 0 else f"b{n}"
+        multilog.put(datum, datum[0])
+
+    expected = list(multilog.read(2))
+    assert list(multilog.read(2, prefetch=2)) == expected
+    # a budget smaller than any segment still makes progress
+    assert list(multilog.read(2, prefetch=3, prefetch_bytes=10)) == expected
+    # abandoning a prefetching read stops it
+    events = multilog.read(1, tags=['a'], prefetch=2)
+    assert next(events)[0] == 3
+    events.close()
+
+
+def test_codecs(tmpdir):
+    metric = StructCodec('metric', '<qd', ('ts', 'value'))
+    db = SerializingMultiLog(str(tmpdir), json.dumps, json.loads, segment_size=5,
+                             codecs={ 'metric': metric, 'event': JSON })
+    for i in range(8):
+        db.put({'ts': i, 'value': i / 2}, tag='metric')
+        db.put({'n': i}, tag='event' if i % 2 else 'other')
+
+    assert db._segfile_for_seg('metric', 0).read_text().splitlines()[:2] == ['#v2 metric', '#codec metric']
+    assert db.get(['metric']) == {'ts': 7, 'value': 3.5}
+    assert db.get(seqno=3) == {'ts': 1, 'value': 0.5}
+    assert db.get_many([2, 4]) == [{'n': 0}, {'n': 1}]
+    events = list(db.read(1, with_tags=True))
+    assert [ e for _, t, e in events if t == 'metric' ] == [ {'ts': i, 'value': i / 2} for i in range(8) ]
+    assert [ e for _, t, e in events if t != 'metric' ] == [ {'n': i} for i in range(8) ]
+    batch = db.read_columns(1, tags=['metric'], fields={ 'value': ('d', lambda e: e['value']) })
+    assert list(batch.columns['value']) == [ i / 2 for i in range(8) ]
+    with pytest.raises(TypeError):
+        Codec()
+
+    # segments keep the codec they were written with
+    db = SerializingMultiLog(str(tmpdir), json.dumps, json.loads, segment_size=5, codecs={ 'metric': metric })
+    db.put({'n': 8}, tag='event')
+    assert [ e for _, e in db.read(15, tags=['event']) ] == [ {'n': 7}, {'n': 8} ]
+    for i in range(3):
+        db.put({'ts': i, 'value': 0.0}, tag='metric')
+    db.put({'n': 9}, tag='event')
+    assert db._segfile_for_seg('event', 3).read_text().splitlines()[:3] == ['#v2 event', '#codec json', '16 {"n":7}']
+    assert db._segfile_for_seg('event', 4).read_text().splitlines() == ['#v2 event', '21 {"n": 9}']
+    assert db.get(['event']) == {'n': 9}
+
+
+def test_tag_registry(multilog, monkeypatch):
+    db = multilog
+    db.put('a', 'metric.cpu')
+    db.put('b', 'metric.mem')
+    db.put('c', 'event')
+    assert sorted(db._tags()) == ['event', 'metric.cpu', 'metric.mem']
+
+    # reads don't scan the directory any more
+    monkeypatch.setattr(db._registry, '_scan', None)
+    assert [ t for _, t, _ in db.read(1, tags=r'metric\..*') ] == ['metric.cpu', 'metric.mem']
+    assert db.get() == 'c'
+
+    # a new tag shows up in cached pattern results
+    db.put('d', 'metric.disk')
+    assert db._resolve_tags(r'metric\..*') == ['metric.cpu', 'metric.disk', 'metric.mem']
+
+
+def test_slice(multilog):
+    db = multilog
+    for i in range(23):
+        db.put(str(i), 'even' if i % 2 == 0 else 'odd')
+
+    everything = db.slice()
+    assert len(everything) == 23
+    assert everything[0] == (1, 'even', '0\n')
+    assert everything[-1] == (23, 'even', '22\n')
+    assert [ s for s, _, _ in everything[5:12:3] ] == [6, 9, 12]
+
+    odd = db.slice(tags=['odd'])
+    assert len(odd) == 11
+    assert [ d.strip() for _, _, d in odd[::-4] ] == ['21', '13', '5']
+    assert odd[3] == (8, 'odd', '7\n')
+    assert list(odd) == list(odd[:])
+    with pytest.raises(IndexError):
+        odd[11]
+
+    # it sees new events
+    db.put('23', 'odd')
+    assert len(odd) == 12
+    assert odd[-1] == (24, 'odd', '23\n')
+
+
+def test_slice_reads_segment_once(multilog, monkeypatch):
+    db = multilog
+    for i in range(23):
+        db.put(str(i), 'even' if i % 2 == 0 else 'odd')
+    reads = []
+    reader = db._segfile_reader
+    def _counting_reader(lines):
+        reads.append(1)
+        return reader(lines)
+    monkeypatch.setattr(db, '_segfile_reader', _counting_reader)
+    # the last page is all in the segment still being written to: one read per tag
+    assert [ s for s, _, _ in db.slice()[-3:] ] == [21, 22, 23]
+    assert len(reads) == 2
+
+
+def test_slice_ser(ser_multilog):
+    db = ser_multilog
+    for i in range(12):
+        db.put({'n': i}, tag='a' if i < 6 else 'b')
+    assert db.slice(tags='b')[1:3] == [(8, {'n': 7}), (9, {'n': 8})]
+    assert len(db.slice(tags=['a'])) == 6
+
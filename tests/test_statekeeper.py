@@ -1,3 +1,13 @@
+import gc
+import threading
+import time
+import weakref
+
+import pytest
+
+from marasa import StateKeeper
+from marasa.compactstate import CompactIndex
+from marasa.statekeeper import MultiWrite
 
 
 def test_single_ns(statekeeper):
@@ -55,3 +65,288 @@ def test_multi_ns(statekeeper):
 
         assert foundin == 1
 
+
+
+def test_torn_tail_recovery(tmpdir):
+    db = StateKeeper(str(tmpdir), segment_size=5)
+    for i in range(7):
+        db.put('ns', {'k': i})
+
+    with db._segfile_for_seg('ns', 1).open('a') as f:
+        f.write('8 {"k":')
+
+    db = StateKeeper(str(tmpdir), segment_size=5)
+    assert len(db.recovery.repairs) == 1
+    assert db.seq == 7
+    assert db.get('ns', 'k') == 6
+
+
+def test_memory_budget(tmpdir):
+    db = StateKeeper(str(tmpdir), segment_size=5, memory_budget=3)
+    for i in range(12):
+        db.put('ns', {f'k{i}': i, 'last': i})
+
+    state = db.get('ns')
+    assert len(state._dirty) + len(state._hot) <= 3
+    assert len(state) == 13
+    assert db.get('ns', 'k2') == 2
+    assert db.get('ns', 'last') == 11
+    assert db.get('ns', 'missing') == db.NOTFOUND
+    assert db.get('ns', 'k7', seqno=7) == db.NOTFOUND
+    assert db.get('ns', 'k7', seqno=8) == 7
+
+    db = StateKeeper(str(tmpdir), segment_size=5, memory_budget=3)
+    assert db.get('ns', 'k4') == 4
+    assert db.get('ns', 'last') == 11
+    assert dict(db.get('ns')) == { 'last': 11, **{ f'k{i}': i for i in range(12) } }
+
+
+def test_read_ns_reverse(statekeeper):
+    db = statekeeper
+    for i in range(12):
+        db.put('ns', {'k': i} if i % 2 else {'j': i})
+
+    assert [ s for s, _ in db.read_ns_reverse('ns') ] == list(range(12, 0, -1))
+    assert list(db.read_ns_reverse('ns', 9, key='k', limit=3)) == [(8, 7), (6, 5), (4, 3)]
+    assert list(db.read_ns_reverse('ns', -3, key='k', limit=2)) == [(8, 7), (6, 5)]
+    assert list(db.read_ns_reverse('ns', -20)) == []
+
+
+def test_delta_segments(tmpdir):
+    db = StateKeeper(str(tmpdir), segment_size=5)
+    for i in range(12):
+        db.put('ns', {f'k{i}': i})
+    db.checkpoints.flush()
+
+    # a new segment starts with only the changes, not a copy of the whole state
+    assert db._segfile_for_seg('ns', 1).read_text().splitlines()[:2] == [ '#delta', '5 {"k4":4}' ]
+    assert db._checkpoint_file('ns', 2).exists()
+    assert db.get('ns', 'k1', seqno=11) == 1
+
+    # a missing checkpoint is rebuilt from earlier segments
+    for seg in (1, 2):
+        db._checkpoint_file('ns', seg).unlink()
+    db = StateKeeper(str(tmpdir), segment_size=5)
+    assert dict(db.get('ns')) == { f'k{i}': i for i in range(12) }
+    assert db.get('ns', seqno=11) == { f'k{i}': i for i in range(11) }
+    assert [ s for s, _ in db.read_ns('ns', 9, 'k0') ] == [9]
+
+
+def test_memory_budget_checkpoints(tmpdir, monkeypatch):
+
+    db = StateKeeper(str(tmpdir), segment_size=5, memory_budget=3)
+    for i in range(22):
+        db.put('ns', {f'k{i}': i})
+    db.checkpoints.flush()
+
+    # segment checkpoints are compact indexes, not json
+    assert not db._checkpoint_file('ns', 3).exists()
+    assert db._compact_checkpoint_files('ns', 3)[0].exists()
+
+    # reading a key from history never loads a whole checkpoint
+    def _no_items(self):
+        raise AssertionError("loaded a whole checkpoint")
+    with monkeypatch.context() as m:
+        m.setattr(CompactIndex, 'items', _no_items)
+        assert db.get('ns', 'k2', seqno=17) == 2
+        assert db.get('ns', 'k16', seqno=16) == db.NOTFOUND
+        assert db.get_many('ns', [3, 12, 21], key='k3') == [db.NOTFOUND, 3, 3]
+        assert [ v for _, v in db.read_ns('ns', 10, 'k0') ] == [0]
+        assert next(db.read(12, key='k1')) == (12, { 'ns': { 'k1': 1 } })
+
+    # missing checkpoints are rebuilt, in budget
+    db.close()
+    for seg in range(1, 5):
+        db._drop_checkpoint('ns', seg)
+    db = StateKeeper(str(tmpdir), segment_size=5, memory_budget=3)
+    state = db.get('ns')
+    assert len(state._dirty) + len(state._hot) <= 3
+    assert dict(state) == { f'k{i}': i for i in range(22) }
+    assert db.get('ns', seqno=11) == { f'k{i}': i for i in range(11) }
+    assert not list((tmpdir / '_checkpoints').listdir('*.build.*'))
+    db.close()
+
+
+def test_checkpointer_shutdown(tmpdir):
+
+    def _join_checkpointers():
+        gc.collect()
+        for t in threading.enumerate():
+            if t.name == 'marasa-checkpoint':
+                t.join(timeout=5)
+
+    # earlier tests' threads stop once their StateKeepers are collected
+    _join_checkpointers()
+    before = threading.active_count()
+    refs = []
+    for n in range(5):
+        db = StateKeeper(str(tmpdir / str(n)), segment_size=5)
+        for i in range(12):
+            db.put('ns', {'k': i})
+        refs.append(weakref.ref(db))
+    with StateKeeper(str(tmpdir / 'closed'), segment_size=5) as db:
+        for i in range(12):
+            db.put('ns', {'k': i})
+    assert db._checkpoint_file('ns', 2).exists()
+    del db
+    gc.collect()
+    assert [ r() for r in refs ] == [None] * 5
+    _join_checkpointers()
+    assert threading.active_count() == before
+
+
+def test_get_many(statekeeper):
+    db = statekeeper
+    for i in range(12):
+        db.put('ns', {'k': i} if i % 2 else {'j': i})
+
+    assert db.get_many('ns', [9, 1, 2, 12], key='k') == [7, db.NOTFOUND, 1, 11]
+    assert db.get_many('ns', [3]) == [{'j': 2, 'k': 1}]
+
+
+def test_as_of(statekeeper):
+    db = statekeeper
+    for i in range(12):
+        db.put(f'ns{i % 3}', {'k': i})
+    view = db.as_of(7)
+    db.put('ns0', {'k': 'later'})
+    db.put('ns3', {'k': 'later'})
+
+    assert list(view) == ['ns0', 'ns1', 'ns2']
+    assert 'ns3' not in view
+    assert { ns: dict(state) for ns, state in view.items() } == { f'ns{n}': db.get(f'ns{n}', seqno=7) for n in range(3) }
+    assert view['ns0']['k'] == 6
+    with pytest.raises(TypeError):
+        view['ns0']['k'] = 0
+    with pytest.raises(KeyError):
+        view['ns3']
+    assert list(db.as_of(1)) == ['ns0']
+
+
+def test_coalesce(tmpdir):
+    db = StateKeeper(str(tmpdir), segment_size=5, coalesce={ 'hot': (3, 60) })
+    for i in range(8):
+        s = db.put('hot', {'counter': i})
+        assert s == i + 1
+        assert db.get('hot', 'counter') == i
+    db.put('cold', {'k': 1})
+    assert db.flush() == { 'hot': (8, 8) }
+
+    # 3 puts per record, and no record spans segments
+    lines = [ l for seg in (0, 1) for l in db._segfile_for_seg('hot', seg).read_text().splitlines()[1:] ]
+    assert lines == [ '3 {"counter":2}', '4 {"counter":3}', '7 {"counter":6}', '8 {"counter":7}' ]
+    assert db.get('hot', 'counter', seqno=5) == 3
+
+    db.put('hot', {'counter': 8})
+    # reads see the pending record from memory, without writing it
+    assert db.get_many('hot', [9, 10], key='counter') == [7, 8]
+    assert list(db.read_ns('hot', 10)) == [ (10, {'counter': 8}) ]
+    assert list(db.read_ns_reverse('hot', key='counter', limit=2)) == [(10, 8), (8, 7)]
+    assert list(db.read(9, key='counter')) == [ (9, { 'hot': { 'counter': 7 }, 'cold': { 'counter': db.NOTFOUND } }),
+                                                (10, { 'hot': { 'counter': 8 } }) ]
+    assert db.as_of(10)['hot'] == {'counter': 8}
+    assert db._batches
+    assert db.flush() == { 'hot': (10, 10) }
+    assert db.get('hot', 'counter', seqno=8) == 7
+    assert [ s for s, _ in db.read_ns('hot', 1, 'counter') ] == [1, 3, 4, 7, 8, 10]
+
+    db = StateKeeper(str(tmpdir), segment_size=5)
+    assert db.seq == 10
+    assert db.get('hot', 'counter') == 8
+
+
+def test_coalesce_durability(tmpdir):
+    with StateKeeper(str(tmpdir), segment_size=5, coalesce={ 'hot': (100, 60) }) as db:
+        for i in range(3):
+            db.put('hot', {'counter': i})
+    db = StateKeeper(str(tmpdir), segment_size=5, coalesce={ 'hot': (100, 0.05) })
+    assert db.seq == 3
+    assert db.get('hot') == {'counter': 2}
+
+    # an idle namespace is still written once max_delay has passed
+    db.put('hot', {'counter': 3})
+    time.sleep(0.5)
+    assert db._batches == {}
+    assert StateKeeper(str(tmpdir), segment_size=5).get('hot', 'counter') == 3
+
+
+def test_coalesce_memory_budget(tmpdir):
+    # puts still waiting in a batch never make it into a compact checkpoint
+    db = StateKeeper(str(tmpdir), segment_size=100, memory_budget=2, coalesce={ 'hot': (1000, 600) })
+    db.put('hot', {'k0': 0})
+    db.flush()
+    for i in range(1, 6):
+        db.put('hot', {f"k{i}": i})
+    assert db.get('hot') == { f"k{i}": i for i in range(6) }
+    reopened = StateKeeper(str(tmpdir), segment_size=100, memory_budget=2)
+    assert reopened.seq == 1
+    assert reopened.get('hot') == {'k0': 0}
+    # as if the first one had crashed
+    for batch in db._batches.values():
+        batch.timer.cancel()
+    db._batches.clear()
+
+
+def test_commit_log(tmpdir):
+    db = StateKeeper(str(tmpdir), segment_size=5, commit_log=True)
+    db.put('ns1', {'k': 0})
+    s = MultiWrite(db).write('ns1', {'k': 1}).write('ns2', {'k': 1}).execute()
+    assert s == 2
+    # nothing copied into the namespaces yet
+    assert not db._segfile_for_seg('ns2', 0).exists()
+    # but it's all readable
+    assert db.get('ns2', 'k') == 1
+    assert db.get('ns1', 'k', seqno=2) == 1
+    assert db.get('ns1', 'k', seqno=1) == 0
+    assert db.get_many('ns1', [1, 2], key='k') == [0, 1]
+    assert [ s for s, _ in db.read_ns('ns1', 1) ] == [1, 2]
+    assert list(db.read_ns_reverse('ns1', key='k')) == [(2, 1), (1, 0)]
+    assert list(db.read(1)) == [ (1, { 'ns1': { 'k': 0 } }), (2, { 'ns1': { 'k': 1 }, 'ns2': { 'k': 1 } }) ]
+    assert { ns: dict(state) for ns, state in db.as_of(2).items() } == { 'ns1': { 'k': 1 }, 'ns2': { 'k': 1 } }
+    assert set(db.namespaces()) == { 'ns1', 'ns2' }
+    # and reading didn't copy anything either
+    assert not db._segfile_for_seg('ns2', 0).exists()
+    assert not (tmpdir / '_txn' / 'applied').exists()
+
+    # a reopened db replays commits that weren't copied before a crash
+    db.multiput({'ns1': {'k': 3}, 'ns3': {'j': 3}})
+    db = StateKeeper(str(tmpdir), segment_size=5, commit_log=True)
+    assert db.seq == 3
+    assert db.get('ns3', 'j') == 3
+    assert [ s for s, _ in db.read_ns('ns1', 1) ] == [1, 2, 3]
+
+    # a torn commit isn't applied at all
+    with (tmpdir / '_txn' / 'txn.000000000').open('a') as f:
+        f.write('4 {"ns1":{"k":4},"ns2"')
+    db = StateKeeper(str(tmpdir), segment_size=5, commit_log=True)
+    assert db.seq == 3
+    assert db.get('ns1', 'k') == 3
+
+    # a put copies the pending commits in first, and so does a commit that starts a new segment
+    db.put('ns4', {'x': 1})
+    assert db._txlog.applied == 3
+    assert db._segfile_for_seg('ns2', 0).read_text().splitlines()[1:] == [ '2 {"k":1}' ]
+    for k in range(5, 11):
+        db.multiput({'ns2': {'k': k}})
+        assert db._txlog.applied == (3 if k < 10 else 9)
+    assert db.get('ns2', 'k', seqno=7) == 7
+    assert [ v for _, v in db.read_ns('ns2', 8, 'k') ][-3:] == [8, 9, 10]
+    db.close()
+    assert db._txlog.applied == 10
+    db = StateKeeper(str(tmpdir), segment_size=5, commit_log=True)
+    assert db.get('ns2', 'k') == 10
+
+
+def test_commit_log_memory_budget(tmpdir):
+    # uncopied commits never make it into a compact checkpoint, so they're replayed after a crash
+    db = StateKeeper(str(tmpdir), segment_size=100, memory_budget=2, commit_log=True)
+    db.put('ns', {'k0': 0})
+    for i in range(1, 5):
+        db.multiput({'ns': {f"k{i}": i}, 'other': {'k': i}})
+    db = StateKeeper(str(tmpdir), segment_size=100, memory_budget=2, commit_log=True)
+    assert db.get('ns') == { f"k{i}": i for i in range(5) }
+    db.put('ns', {'k5': 5})
+    assert [ s for s, _ in db.read_ns('ns', 1) ] == [1, 2, 3, 4, 5, 6]
+    db.close()
+    db = StateKeeper(str(tmpdir), segment_size=100, memory_budget=2, commit_log=True)
+    assert db.get('ns') == { f"k{i}": i for i in range(6) }